@@ -0,0 +1,5 @@
+complete -c cbl_prep_krnl_srcs -f
+complete -c cbl_prep_krnl_srcs -f -s h -l help -d "Show help message and exit"
+complete -c cbl_prep_krnl_srcs -x -s j -l jobs -d "Number of trees to prepare at the same time"
+complete -c cbl_prep_krnl_srcs -x -s R -l ref -d "Reference to base kernel trees on"
+complete -c cbl_prep_krnl_srcs -f -d "Positional arguments" -a "fedora\t'Kernel tree' linux-mainline-llvm\t'Kernel tree' linux-next-llvm\t'Kernel tree'"
@@ -0,0 +1,2 @@
+complete -c cbl_rb_fd -f
+complete -c cbl_rb_fd -f -s n -l no-update -d "Do not prepare the source tree before building it"
@@ -261,6 +261,8 @@ complete -c kmake -f -l omit-hostldflags -d "Avoid default use of HOSTLDFLAGS="
 complete -c kmake -f -l omit-o-arg -d "Avoid default use of O="
 complete -c kmake -x -s p -l prepend-to-path -d "Prepend specified directory to PATH" -a '(__fish_complete_directories)'
 complete -c kmake -x -s j -l jobs -d "Number of jobs"
+complete -c kmake -r -l log-file -d "Save the output of make to this file as well"
+complete -c kmake -f -s l -l load-limit -d "Limit load average to the number of available CPUs"
 complete -c kmake -f -l use-time -d "Call 'time -v' for time tracking"
 complete -c kmake -x -s v -l verbose -d "Do a more verbose build"
 
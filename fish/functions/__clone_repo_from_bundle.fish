@@ -42,6 +42,10 @@ function __clone_repo_from_bundle -d "Clone repo using a clone bundle if possibl
     set nas_bundle $NAS_FOLDER/bundles/$repo.bundle
     if test -e $nas_bundle
         set bundle $nas_bundle
+        # nas_sync.py stacks delta bundles on top of the full bundle, which
+        # have to be fetched in order after it (globs are sorted and the
+        # deltas are numbered with leading zeros)
+        set delta_bundles $NAS_FOLDER/bundles/$repo-*.delta.bundle
     end
     if not set -q bundle
         if test $num_args -eq 3
@@ -65,7 +69,20 @@ function __clone_repo_from_bundle -d "Clone repo using a clone bundle if possibl
 
     if set -q bundle
         git clone $bundle $dest
-        and git -C $dest remote remove origin
+        or return
+
+        # Each delta bundle requires all refs of the bundles before it, not
+        # just the branches and tags that 'git clone' fetches, so fetch all of
+        # them into a temporary namespace. This avoids downloading the objects
+        # in them again during the 'git remote update' below.
+        if set -q delta_bundles[1]
+            for fetch_bundle in $bundle $delta_bundles
+                git -C $dest fetch --quiet --no-tags $fetch_bundle '+refs/*:refs/bundles/*'
+                or return
+            end
+        end
+
+        git -C $dest remote remove origin
         and git -C $dest remote add origin $url
         and if set -q configs
             for config in configs
@@ -74,6 +91,7 @@ function __clone_repo_from_bundle -d "Clone repo using a clone bundle if possibl
             end
         end
         and git -C $dest remote update --prune origin
+        and git -C $dest for-each-ref --format='delete %(refname)' refs/bundles/ | git -C $dest update-ref --stdin
         and git -C $dest checkout $branch
         and git -C $dest branch --set-upstream-to origin/$branch
         and git -C $dest reset --hard origin/$branch
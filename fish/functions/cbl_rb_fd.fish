@@ -6,9 +6,19 @@ function cbl_rb_fd -d "Rebase generic Fedora kernel on latest linux-next"
     __in_container_msg -c
     or return
 
-    # Prepare kernel source
-    PYTHONPATH=$PYTHON_FOLDER/lib python3 -c "import kernel; kernel.prepare_source('fedora')"
-    or return
+    for arg in $argv
+        switch $arg
+            case -n --no-update
+                set no_update true
+        end
+    end
+
+    # Prepare kernel source, unless it has already been prepared along with
+    # other trees via cbl_prep_krnl_srcs
+    if test "$no_update" != true
+        cbl_prep_krnl_srcs fedora
+        or return
+    end
 
     # Build kernel
     set lnx_src $CBL_SRC_P/fedora
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import random
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath('scripts')))
+import cbl_gen_build_report
+import harness
+
+SRC_FOLDER = Path('/home/nathan/src/linux-next')
+# A mix of lines that are not problems, problems that are reported, and
+# problems that are filtered
+LINES = (
+    '  CC      drivers/gpu/drm/amd/amdgpu/amdgpu_device.o\n',
+    '  LD [M]  fs/btrfs/btrfs.ko\n',
+    '  AR      built-in.a\n',
+    f"{SRC_FOLDER}/drivers/net/wireless/foo.c:{{}}:5: warning: variable 'x' set but not used [-Wunused-but-set-variable]\n",
+    f"{SRC_FOLDER}/lib/bar.c:{{}}:12: error: call to undeclared function 'baz'\n",
+    'vmlinux.o: warning: objtool: qux+0x{}: call to __ubsan_handle_load_invalid_value() leaves .noinstr.text section\n',
+    f"{SRC_FOLDER}/arch/mips/kernel/genex.S:{{}}: Warning: macro defined with named parameters\n",
+)
+# Most lines in a build log are not problems
+WEIGHTS = (300, 300, 300, 2, 1, 2, 1)
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Compare the cbl_gen_build_report warning scanner against a serial two pass scan'
+    )
+
+    parser.add_argument(
+        '-c',
+        '--count',
+        default=200,
+        help='Number of synthetic logs to generate (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        '-l',
+        '--lines',
+        default=50000,
+        help='Number of lines in each synthetic log (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        'folder',
+        help='Existing log folder to scan instead of a synthetic one',
+        nargs='?',
+        type=Path,
+    )
+
+    return parser.parse_args()
+
+
+def generate_corpus(folder: Path, count: int, lines: int) -> None:
+    rng = random.Random(0)  # ruff:ignore[suspicious-non-cryptographic-random-usage]
+    for idx in range(count):
+        choices = rng.choices(LINES, weights=WEIGHTS, k=lines)
+        Path(folder, f"{idx:04d}.log").write_text(
+            ''.join(line.format(rng.randrange(1000)) for line in choices), encoding='utf-8'
+        )
+
+
+# The implementation of generate_warnings() prior to the parallel scanner
+def serial_baseline(
+    log_folder: Path, src_folder: Path
+) -> tuple[
+    cbl_gen_build_report.WarningsDict,
+    cbl_gen_build_report.WarningsDict,
+    cbl_gen_build_report.Warnings,
+]:
+    internal_files = {elem + '.log' for elem in ['failed', 'info', 'skipped', 'success']}
+    internal_files.add('report.txt')
+    logs = sorted(elem for elem in log_folder.iterdir() if elem.name not in internal_files)
+
+    warnings = {}
+    for log in logs:
+        lines = log.read_text(encoding='utf-8').splitlines(keepends=True)
+        warnings[log.name] = sorted(
+            {
+                line.replace(f"{src_folder}/", '')
+                for line in lines
+                if cbl_gen_build_report.PROBLEM_RE.search(line) and 'dodgy linker' not in line
+            }
+        )
+    full = {key: value for key, value in warnings.items() if value}
+
+    warnings = {}
+    for log, problems in full.items():
+        warnings[log] = sorted(
+            {item for item in problems if not cbl_gen_build_report.IGNORE_RE.search(item)}
+        )
+    filtered = {key: value for key, value in warnings.items() if value}
+
+    unique = sorted({item for problems in filtered.values() for item in problems})
+
+    return full, filtered, unique
+
+
+def run_benchmark(folder: Path) -> None:
+    logs = list(folder.glob('*.log'))
+    total_bytes = sum(log.stat().st_size for log in logs)
+    harness.compare(
+        f"Scanning {len(logs)} logs ({total_bytes // 1048576} MB)",
+        {
+            'serial two pass': lambda: serial_baseline(folder, SRC_FOLDER),
+            'generate_warnings()': lambda: cbl_gen_build_report.generate_warnings(
+                folder, SRC_FOLDER
+            ),
+        },
+        harness.throughput(total_bytes / 1048576, 'MB'),
+    )
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.folder:
+        run_benchmark(args.folder)
+    else:
+        with TemporaryDirectory() as tmpdir:
+            generate_corpus(Path(tmpdir), args.count, args.lines)
+            run_benchmark(Path(tmpdir))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath('scripts')))
+import filter_dmesg
+import harness
+
+# A mix of lines that are filtered by the 'common' and 'chromebox3' allowlists
+# and lines that are not filtered, in the format of 'dmesg --color=always'
+LINES = (
+    '\033[32m[{}.000000] \033[0m\033[33mhrtimer: interrupt took 12345 ns\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33msd 0:0:0:0: Power-on or device reset occurred\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33mnvme nvme0: using unchecked data buffer\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33mblock sda: the capability attribute has been deprecated.\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33mrt5663 i2c-10EC5663:00 sysclk < 384 x fs, disable i2s asrc\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33musb: port power management may be unreliable\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[31mBUG: kernel NULL pointer dereference, address: 0000000000000008\033[0m',
+    '\033[32m[{}.000000] \033[0m\033[33mWARNING: CPU: 3 PID: 1 at mm/slub.c:1234 foo+0x10/0x20\033[0m',
+)
+# Most lines in dmesg are known warnings
+WEIGHTS = (50, 50, 50, 50, 50, 50, 1, 1)
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Compare the filter_dmesg allowlist matcher against searching each entry'
+    )
+
+    parser.add_argument(
+        '-H',
+        '--hostname',
+        default='chromebox3',
+        help='Host whose allowlist to use (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-l',
+        '--lines',
+        default=200000,
+        help='Number of lines in the synthetic dmesg (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        'file',
+        help='Captured dmesg to filter instead of a synthetic one',
+        nargs='?',
+        type=Path,
+    )
+
+    return parser.parse_args()
+
+
+def generate_dmesg(lines: int) -> list[str]:
+    rng = random.Random(0)  # ruff:ignore[suspicious-non-cryptographic-random-usage]
+    return [
+        line.format(idx) for idx, line in enumerate(rng.choices(LINES, weights=WEIGHTS, k=lines))
+    ]
+
+
+# The implementation of the filter prior to AllowlistMatcher
+def search_baseline(dmesg_lines: list[str], allowlist: list[str]) -> list[str]:
+    unexpected = []
+    for dmesg_line in dmesg_lines:
+        escaped_line = filter_dmesg.ANSI_STRIP.sub('', dmesg_line)
+        for regex in allowlist:
+            if re.search(regex, escaped_line):
+                break
+        else:
+            unexpected.append(dmesg_line)
+    return unexpected
+
+
+def matcher(dmesg_lines: list[str], allowlist: list[str]) -> list[str]:
+    allowlist_matcher = filter_dmesg.AllowlistMatcher(allowlist)
+    return [line for line, entry in allowlist_matcher.filter(dmesg_lines) if not entry]
+
+
+def run_benchmark(dmesg_lines: list[str], hostname: str) -> None:
+    allowlist = filter_dmesg.ALLOWLIST['common'] + filter_dmesg.ALLOWLIST[hostname]
+    harness.compare(
+        f"Filtering {len(dmesg_lines)} lines with {len(allowlist)} allowlist entries",
+        {
+            're.search() per entry': lambda: search_baseline(dmesg_lines, allowlist),
+            'AllowlistMatcher': lambda: matcher(dmesg_lines, allowlist),
+        },
+        harness.throughput(len(dmesg_lines), 'lines'),
+    )
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.file:
+        run_benchmark(args.file.read_text(encoding='utf-8').splitlines(), args.hostname)
+    else:
+        run_benchmark(generate_dmesg(args.lines), args.hostname)
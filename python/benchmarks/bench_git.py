@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import subprocess
+import sys
+from argparse import ArgumentParser
+from collections.abc import Callable
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import harness
+import lib.git
+import lib.utils
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Compare forking git for each query against lib.git.GitQuery'
+    )
+
+    parser.add_argument(
+        '-c',
+        '--count',
+        default=100,
+        help='Number of commits to query (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        '-p',
+        '--path',
+        default='README.md',
+        help='File to show in each commit, which must exist in all of them (default: %(default)s)',
+    )
+    parser.add_argument(
+        'repo',
+        default=Path(__file__).resolve().parents[2],
+        help='Repository to query (default: %(default)s)',
+        nargs='?',
+        type=Path,
+    )
+
+    return parser.parse_args()
+
+
+def call_git_queries(repo: Path, revs: list[str], path: str) -> list[tuple[str, str, str]]:
+    results = []
+    for rev in revs:
+        sha = lib.utils.get_git_output(repo, ['rev-parse', '--verify', rev])
+        subject = lib.utils.get_git_output(repo, ['show', '--format=%s', '--no-patch', rev])
+        contents = lib.utils.call_git(repo, ['show', f"{rev}:{path}"]).stdout
+        results.append((sha, subject, contents))
+    lib.utils.get_git_output(repo, ['for-each-ref', '--format=%(refname:short)', 'refs/heads/'])
+    lib.utils.get_git_output(repo, ['for-each-ref', '--format=%(refname:short)', 'refs/tags/'])
+    return results
+
+
+def git_query_queries(repo: Path, revs: list[str], path: str) -> list[tuple[str, str, str]]:
+    query = lib.git.GitQuery(repo)
+    results = [
+        (query.rev_parse(rev), query.get_commit_subject(rev), query.show_file(rev, path))
+        for rev in revs
+    ]
+    query.get_refs('refs/heads/')
+    query.get_refs('refs/tags/')
+    query.close()
+    return results
+
+
+def count_forks(func: Callable[[], object], forks: dict[str, int], name: str) -> object:
+    popen_init = subprocess.Popen.__init__
+
+    def counting_popen_init(self, *args, **kwargs):
+        forks[name] += 1
+        popen_init(self, *args, **kwargs)
+
+    forks[name] = 0
+    subprocess.Popen.__init__ = counting_popen_init
+    try:
+        return func()
+    finally:
+        subprocess.Popen.__init__ = popen_init
+
+
+def run_benchmark(repo: Path, count: int, path: str) -> None:
+    revs = lib.utils.get_git_output(repo, ['rev-list', f"--max-count={count}", 'HEAD']).split()
+    forks: dict[str, int] = {}
+    harness.compare(
+        f"Querying {len(revs)} commits in {repo}",
+        {
+            name: lambda name=name, func=func: count_forks(
+                lambda: func(repo, revs, path), forks, name
+            )
+            for name, func in (('call_git()', call_git_queries), ('GitQuery', git_query_queries))
+        },
+        lambda name, _elapsed: f"{forks[name]:5d} processes spawned",
+    )
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    run_benchmark(args.repo, args.count, args.path)
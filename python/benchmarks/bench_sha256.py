@@ -0,0 +1,106 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "requests>=2.32.5",
+# ]
+# [tool.ty.environment]
+# root = ["./python"]
+# ///
+
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import hashlib
+import os
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import harness
+import lib.sha256
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Compare lib.sha256 hashing throughput against a serial 1MB read loop'
+    )
+
+    parser.add_argument(
+        '-a',
+        '--algorithm',
+        choices=['blake2b', 'sha256'],
+        default='sha256',
+        help='Hash algorithm to benchmark (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-c',
+        '--count',
+        default=8,
+        help='Number of files to generate when no files are provided (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        '-d',
+        '--directory',
+        help='Folder to generate files in, such as one on NFS (default: a temporary folder)',
+        type=Path,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of hashing threads (default: one per file up to the number of CPUs)',
+        type=int,
+    )
+    parser.add_argument(
+        '-s',
+        '--size',
+        default=256,
+        help='Size of each generated file in MB (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument('files', help='Existing files to hash', nargs='*', type=Path)
+
+    return parser.parse_args()
+
+
+# The implementation of lib.sha256.calculate() prior to the batch API
+def serial_baseline(files: list[Path], algorithm: str) -> dict[Path, str]:
+    hashes = {}
+    for file_path in files:
+        file_hash = hashlib.new(algorithm)
+        with file_path.open('rb') as file:
+            while chunk := file.read(1048576):
+                file_hash.update(chunk)
+        hashes[file_path] = file_hash.hexdigest()
+    return hashes
+
+
+def run_benchmark(files: list[Path], algorithm: str, jobs: int | None) -> None:
+    total_bytes = sum(file.stat().st_size for file in files)
+    # The first pass warms the page cache so that both implementations are
+    # measured against the same state.
+    harness.compare(
+        f"Hashing {len(files)} files ({total_bytes // 1048576} MB) with {algorithm}",
+        {
+            'serial (1MB reads)': lambda: serial_baseline(files, algorithm),
+            'calculate_many()': lambda: lib.sha256.calculate_many(files, algorithm, jobs),
+        },
+        harness.throughput(total_bytes / 1048576, 'MB'),
+    )
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.files:
+        run_benchmark(args.files, args.algorithm, args.jobs)
+    else:
+        with TemporaryDirectory(dir=args.directory) as tmpdir:
+            generated = []
+            for idx in range(args.count):
+                generated.append(file := Path(tmpdir, f"{idx}.bin"))
+                file.write_bytes(os.urandom(args.size * 1048576))
+            run_benchmark(generated, args.algorithm, args.jobs)
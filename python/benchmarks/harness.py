@@ -0,0 +1,39 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import lib.utils
+
+
+def throughput(amount: float, unit: str) -> Callable[[str, float], str]:
+    return lambda _name, elapsed: f"{amount / elapsed:12.1f} {unit}/s"
+
+
+# Run each implementation once in order, print how long it took along with
+# the result of describe(), then check that every implementation returned the
+# same results as the first one, which should be the baseline.
+def compare(
+    title: str,
+    implementations: dict[str, Callable[[], object]],
+    describe: Callable[[str, float], str],
+) -> None:
+    lib.utils.print_header(title)
+
+    width = max(map(len, implementations))
+    results = {}
+    for name, func in implementations.items():
+        start = time.perf_counter()
+        results[name] = func()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>{width}}: {elapsed:8.3f}s ({describe(name, elapsed)})")
+
+    baseline, *others = results
+    for name in others:
+        if results[name] != results[baseline]:
+            msg = f"{name} results do not match {baseline} results!"
+            raise RuntimeError(msg)
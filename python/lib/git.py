@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import atexit
+import subprocess
+import threading
+from functools import cache
+from pathlib import Path
+
+from . import utils
+
+
+class GitQuery:
+    # Answers object, ref, and blob lookups for a repository through a single
+    # long running 'git cat-file --batch-command' process, instead of forking
+    # git for each query with utils.call_git(). Only use this for read only
+    # queries, as refs that are changed after they have been looked up may
+    # not be reflected in later lookups.
+
+    def __init__(self, repo: Path) -> None:
+        self.repo: Path = repo
+        self.refs: dict[str, str] | None = None
+
+        self._lock = threading.Lock()
+        # Started on the first lookup, as some users only need refs
+        self._proc: subprocess.Popen | None = None
+
+    def _command(self, command: str, obj: str) -> tuple[str, str, bytes | None] | None:
+        # Objects cannot be looked up across newlines, so there is no valid
+        # answer for them.
+        if '\n' in obj:
+            return None
+        with self._lock:
+            if not self._proc:
+                self._proc = subprocess.Popen(
+                    ['git', 'cat-file', '--batch-command'],
+                    cwd=self.repo,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+            self._proc.stdin.write(f"{command} {obj}\n".encode())  # ty: ignore[possibly-missing-attribute]
+            self._proc.stdin.flush()  # ty: ignore[possibly-missing-attribute]
+
+            # '<oid> <type> <size>' or '<object> missing' / '<object> ambiguous'
+            header = self._proc.stdout.readline().decode()  # ty: ignore[possibly-missing-attribute]
+            if not header:
+                msg = f"git cat-file in {self.repo} exited unexpectedly!"
+                raise RuntimeError(msg)
+            if (fields := header.split()) and fields[-1] in {'ambiguous', 'missing'}:
+                return None
+            oid, obj_type, size = fields
+
+            contents = None
+            if command == 'contents':
+                # Contents are followed by a newline
+                contents = self._proc.stdout.read(int(size) + 1)[:-1]  # ty: ignore[possibly-missing-attribute]
+
+        return oid, obj_type, contents
+
+    def rev_parse(self, rev: str) -> str | None:
+        # Equivalent to 'git rev-parse --verify --quiet <rev>'
+        if not (info := self._command('info', rev)):
+            return None
+        return info[0]
+
+    def get_type(self, rev: str) -> str | None:
+        if not (info := self._command('info', rev)):
+            return None
+        return info[1]
+
+    def get_contents(self, rev: str) -> bytes | None:
+        if not (contents := self._command('contents', rev)):
+            return None
+        return contents[2]
+
+    def show_file(self, rev: str, path: str) -> str | None:
+        # Equivalent to 'git show <rev>:<path>'
+        if (contents := self.get_contents(f"{rev}:{path}")) is None:
+            return None
+        return contents.decode('utf-8')
+
+    def get_commit_subject(self, rev: str) -> str | None:
+        # Equivalent to 'git show --format=%s --no-patch <rev>'
+        if (contents := self.get_contents(f"{rev}^{{commit}}")) is None:
+            return None
+        # The message follows the headers after a blank line
+        message = contents.decode('utf-8', errors='replace').split('\n\n', 1)[1]
+        return message.split('\n\n', 1)[0].replace('\n', ' ').strip()
+
+    def get_refs(self, prefix: str = 'refs/') -> dict[str, str]:
+        # Take a snapshot of all refs with one 'git for-each-ref' the first
+        # time refs are requested, which serves all later requests.
+        if self.refs is None:
+            for_each_ref = utils.get_git_output(
+                self.repo, ['for-each-ref', '--format=%(refname) %(objectname)']
+            )
+            self.refs = dict(line.split(' ', 1) for line in for_each_ref.splitlines())
+        return {
+            ref.removeprefix(prefix): oid
+            for ref, oid in self.refs.items()
+            if ref.startswith(prefix)
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._proc:
+                return
+            if self._proc.poll() is None:
+                self._proc.stdin.close()  # ty: ignore[possibly-missing-attribute]
+                self._proc.wait()
+            self._proc.stdout.close()  # ty: ignore[possibly-missing-attribute]
+            self._proc = None
+
+
+@cache
+def get_query(repo: Path) -> GitQuery:
+    # Share one query process per repository for the lifetime of the script
+    query = GitQuery(Path(repo).resolve())
+    atexit.register(query.close)
+    return query
@@ -3,20 +3,51 @@
 # Copyright (C) 2022-2023 Nathan Chancellor
 
 import email
+import hashlib
+import json
 import os
+import re
 import shlex
 import shutil
+import socket
 import sys
 import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from subprocess import CalledProcessError, CompletedProcess
-from tempfile import TemporaryDirectory
+from tempfile import NamedTemporaryFile, TemporaryDirectory, TemporaryFile
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import resource
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import lib.utils
 
 NEXT_TREES: tuple[str, ...] = ('fedora', 'linux-next-llvm')
 PACMAN_TREES: tuple[str, ...] = ('linux-mainline-llvm', 'linux-next-llvm')
+# Maximum number of patches to download at the same time
+PATCH_FETCH_JOBS = 8
+# Downloaded patches that have not been used in this many seconds are removed
+PATCH_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+# Namespace for refs that point to the result of prepare_source(), which
+# contains a namespace for each tree, as trees may be worktrees of the same
+# repository and refs outside of refs/worktree/ are shared between worktrees
+SNAPSHOT_REFS = 'refs/prepare-source/'
+# Maximum number of trees to update and patch at the same time
+SOURCE_PREP_JOBS = 4
+# cgroup v2 hierarchy, for CPU and memory limits of containers and services
+CGROUP_ROOT = Path('/sys/fs/cgroup')
+# Number of previous builds of a configuration to estimate peak memory from
+MEM_ESTIMATE_BUILDS = 5
+# Memory that a typical compile job needs in kB, as the peak memory of a build
+# is usually that of a single serial step, such as linking vmlinux. This can be
+# overridden in MiB with KMAKE_JOB_MEM_MB for configurations with larger
+# compile jobs, such as allmodconfig with KASAN.
+COMPILE_JOB_MEM_KB = 512 * 1024
+# Number of most recent records to read from the build database
+BUILD_RECORDS_READ = 1000
 
 
 def b4(cmd: lib.utils.ValidCmd, **kwargs) -> CompletedProcess:
@@ -65,6 +96,100 @@ def b4_gen_series_commits(
     return series, commits
 
 
+def get_patch_cache() -> Path:
+    return Path(
+        os.environ.get('XDG_CACHE_FOLDER', Path.home().joinpath('.cache')), 'prepare_source/patches'
+    )
+
+
+def prune_patch_cache() -> None:
+    # Using a patch refreshes its modification time, so this removes patches
+    # that have not been used in a while, as well as temporary files that were
+    # left behind by interrupted downloads.
+    cutoff = time.time() - PATCH_CACHE_MAX_AGE
+    for item in get_patch_cache().iterdir():
+        try:
+            if item.stat().st_mtime < cutoff:
+                item.unlink()
+        # Another process may have pruned or replaced it in the meantime
+        except FileNotFoundError:
+            continue
+
+
+def fetch_patch(patch: Path | str) -> Path | str:
+    if isinstance(patch, Path):
+        return patch
+    if patch.lstrip().startswith('From ') and 'diff --git' in patch:
+        return patch
+    if not patch.startswith(('https://', 'http://')):
+        msg = f"Can't handle {patch}?"
+        raise RuntimeError(msg)
+
+    # Downloaded patches do not change, so keep them around to avoid
+    # downloading them again on the next build. Key lore patches by their
+    # message-ID, so that the different forms of lore links all share the same
+    # entry, but keep the output of 'b4 am' separate from the raw message.
+    use_b4 = patch.startswith('https://lore.kernel.org/') and not patch.endswith('/raw')
+    if match := re.search(r'lore\.kernel\.org/(?:[^/]+/)?([^/]+@[^/]+)', patch):
+        key = match.group(1) if use_b4 else f"{match.group(1)}/raw"
+    else:
+        key = patch
+    cache_file = Path(get_patch_cache(), f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.patch")
+    if cache_file.exists():
+        cache_file.touch()
+        return cache_file.read_text(encoding='utf-8')
+
+    if use_b4:
+        patch_txt = b4_am_o(patch)
+    else:
+        # curl is banned due to bot attacks
+        fetch_func = lib.utils.wget if 'lore.kernel.org' in patch else lib.utils.curl
+        patch_txt = fetch_func(patch).decode('utf-8', 'ignore')
+
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    # Other builds may be fetching the same patch at the same time, so each
+    # one needs its own temporary file.
+    with NamedTemporaryFile(
+        'w', encoding='utf-8', dir=cache_file.parent, suffix='.tmp', delete=False
+    ) as tmp_file:
+        tmp_file.write(patch_txt)
+    Path(tmp_file.name).replace(cache_file)
+    prune_patch_cache()
+
+    return patch_txt
+
+
+def get_snapshot_refs(base_name: str) -> str:
+    return f"{SNAPSHOT_REFS}{base_name}/"
+
+
+def get_snapshot_ref(
+    base_name: str, base_sha: str, reverts: list, patches: list[Path | str], commits: list[str]
+) -> str:
+    # Patching is deterministic, so the result only depends on the base
+    # commit and the changes applied on top of it in order.
+    snapshot_hash = hashlib.sha256(base_sha.encode('utf-8'))
+    for revert in reverts:
+        snapshot_hash.update(f"\0revert\0{revert!r}".encode())
+    for patch in patches:
+        patch_txt = patch.read_text(encoding='utf-8') if isinstance(patch, Path) else patch
+        snapshot_hash.update(f"\0patch\0{patch_txt}".encode())
+    for commit in commits:
+        snapshot_hash.update(f"\0commit\0{commit}".encode())
+    return f"{get_snapshot_refs(base_name)}{snapshot_hash.hexdigest()}"
+
+
+def save_snapshot_ref(source_folder: Path, base_name: str, snapshot_ref: str) -> None:
+    # Only the latest snapshot of each tree is useful, as the base moves
+    # forward, but leave the snapshots of other trees alone.
+    stale_refs = lib.utils.get_git_output(
+        source_folder, ['for-each-ref', '--format=%(refname)', get_snapshot_refs(base_name)]
+    ).splitlines()
+    update_ref_input = ''.join(f"delete {ref}\n" for ref in stale_refs if ref != snapshot_ref)
+    update_ref_input += f"update {snapshot_ref} HEAD\n"
+    lib.utils.call_git(source_folder, ['update-ref', '--stdin'], input=update_ref_input)
+
+
 def get_msg_id_subject(mail_str: str) -> tuple[str, str]:
     mail_msg = email.message_from_string(mail_str)
 
@@ -85,7 +210,7 @@ def get_msg_id_subject(mail_str: str) -> tuple[str, str]:
     return msg_id, subject
 
 
-def prepare_source(base_name: str, base_ref: str = 'origin/master') -> None:
+def prepare_source(base_name: str, base_ref: str = 'origin/master', update: bool = True) -> None:
     if base_name == 'linux-debug':
         return  # managed outside of the script
     if base_name not in {*NEXT_TREES, 'linux-mainline-llvm'}:
@@ -94,9 +219,6 @@ def prepare_source(base_name: str, base_ref: str = 'origin/master') -> None:
 
     source_folder = Path(os.environ['CBL_SRC_P'], base_name)
 
-    lib.utils.call_git(source_folder, ['remote', 'update', '--prune', 'origin'])
-    lib.utils.call_git_loud(source_folder, ['reset', '--hard', base_ref])
-
     reverts: list[str] = []
     patches: list[str] = []
     commits: list[str] = []
@@ -155,64 +277,198 @@ index 268b5fbdb48b..93e7ec301268 100644
 ''',  # ruff:ignore[trailing-whitespace]
         ]
 
-    try:  # ruff:ignore[too-many-statements-in-try-clause]
-        for revert in reverts:
-            if isinstance(revert, tuple):
-                commit_range = revert[0]
-                commit_msg = revert[1]
+    # Download all patches at the same time while the tree is being updated,
+    # rather than one at a time before applying each one.
+    with ThreadPoolExecutor(max_workers=min(len(patches), PATCH_FETCH_JOBS) or 1) as executor:
+        fetched_patches = executor.map(fetch_patch, patches)
 
-                if '..' not in commit_range:
-                    msg = f"No git range indicator in {commit_range}"
-                    raise RuntimeError(msg)
+        if update:
+            update_remote(source_folder)
 
-                # generate diff from range
-                range_diff = lib.utils.call_git(source_folder, ['diff', commit_range]).stdout
-
-                # apply diff in reverse
-                lib.utils.call_git_loud(
-                    source_folder, ['apply', '--3way', '--reverse'], input=range_diff
+        try:  # ruff:ignore[too-many-statements-in-try-clause]
+            # If the base and everything applied on top of it are the same as
+            # a previous run, reuse its result rather than patching again.
+            fetched_patches = list(fetched_patches)
+            base_sha = lib.utils.get_git_output(
+                source_folder, ['rev-parse', '--verify', f"{base_ref}^{{commit}}"]
+            )
+            commit_shas = [
+                lib.utils.get_git_output(
+                    Path(os.environ['CBL_SRC_P'], 'linux-next'), ['rev-parse', '--verify', commit]
                 )
+                for commit in commits
+            ]
+            snapshot_ref = get_snapshot_ref(
+                base_name, base_sha, reverts, fetched_patches, commit_shas
+            )
+            if (
+                lib.utils.call_git(
+                    source_folder, ['rev-parse', '--verify', '--quiet', snapshot_ref], check=False
+                ).returncode
+                == 0
+            ):
+                lib.utils.call_git_loud(source_folder, ['reset', '--hard', snapshot_ref])
+                return
+
+            lib.utils.call_git_loud(source_folder, ['reset', '--hard', base_sha])
+
+            for revert in reverts:
+                if isinstance(revert, tuple):
+                    commit_range = revert[0]
+                    commit_msg = revert[1]
+
+                    if '..' not in commit_range:
+                        msg = f"No git range indicator in {commit_range}"
+                        raise RuntimeError(msg)
+
+                    # generate diff from range
+                    range_diff = lib.utils.call_git(source_folder, ['diff', commit_range]).stdout
+
+                    # apply diff in reverse
+                    lib.utils.call_git_loud(
+                        source_folder, ['apply', '--3way', '--reverse'], input=range_diff
+                    )
+
+                    # commit the result
+                    lib.utils.call_git_loud(
+                        source_folder, ['commit', '--no-gpg-sign', '-m', commit_msg]
+                    )
+                else:
+                    lib.utils.call_git_loud(
+                        source_folder,
+                        ['revert', '--mainline', '1', '--no-edit', '--no-gpg-sign', revert],
+                    )
+
+            for patch in fetched_patches:
+                am_cmd = ['am', '-3', '--no-gpg-sign']
+                am_kwargs = {}
+
+                if isinstance(patch, Path):
+                    am_cmd.append(patch)
+                else:
+                    am_kwargs['input'] = patch
+
+                lib.utils.call_git_loud(source_folder, am_cmd, **am_kwargs)
+
+            for commit in commit_shas:
+                patch_input = lib.utils.call_git(
+                    Path(os.environ['CBL_SRC_P'], 'linux-next'),
+                    ['fp', '-1', '--stdout', commit],
+                ).stdout
+                lib.utils.call_git_loud(source_folder, ['am', '-3'], input=patch_input)
+
+            save_snapshot_ref(source_folder, base_name, snapshot_ref)
+        except CalledProcessError as err:
+            lib.utils.call_git(source_folder, 'ama', check=False)
+            print(f"\n[FAILED] {' '.join(err.cmd)}")
+            sys.exit(err.returncode)
+
+
+def update_remote(source_folder: Path) -> None:
+    lib.utils.call_git(source_folder, ['remote', 'update', '--prune', 'origin'])
 
-                # commit the result
-                lib.utils.call_git_loud(
-                    source_folder, ['commit', '--no-gpg-sign', '-m', commit_msg]
-                )
+
+def run_buffered(func: Callable[..., None], *args) -> tuple[float, str, str | None]:
+    # Run in a separate process for each tree with all of its output, including
+    # the output of the commands that it runs, going to a temporary file, so
+    # that the output of trees that are prepared at the same time is not
+    # interleaved. Returns the duration, the output, and the error, if any.
+    start = time.time()
+    error = None
+    saved_fds = (os.dup(1), os.dup(2))
+    with TemporaryFile(mode='w+', encoding='utf-8', errors='replace') as output:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            func(*args)
+        # prepare_source() exits when a patch fails to apply
+        except (CalledProcessError, OSError, RuntimeError, SystemExit) as err:
+            error = str(err) or repr(err)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in enumerate(saved_fds, 1):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+        output.seek(0)
+        return time.time() - start, output.read(), error
+
+
+def prepare_sources(
+    base_names: list[str], base_ref: str = 'origin/master', jobs: int | None = None
+) -> dict[str, float]:
+    # Updating and patching trees is mostly waiting on the network and git,
+    # so prepare several trees at the same time to overlap that waiting.
+    durations: dict[str, float] = {}
+    failed: list[str] = []
+
+    # Trees may be worktrees of the same repository, which share their remote
+    # refs, so fetch each repository once before preparing the trees, rather
+    # than letting the trees race to update the same refs.
+    repos: dict[Path, list[str]] = {}
+    for base_name in base_names:
+        source_folder = Path(os.environ['CBL_SRC_P'], base_name)
+        try:
+            common_dir = lib.utils.get_git_output(source_folder, ['rev-parse', '--git-common-dir'])
+        except (CalledProcessError, OSError) as err:
+            lib.utils.print_red(f"ERROR: {source_folder} is not a git repository: {err}")
+            failed.append(base_name)
+            continue
+        # The common directory is the .git folder of a non-bare repository
+        repo = Path(source_folder, common_dir).resolve()
+        repos.setdefault(repo.parent if repo.name == '.git' else repo, []).append(base_name)
+
+    def run_all(
+        executor: ProcessPoolExecutor, tasks: dict[str, tuple]
+    ) -> dict[str, tuple[float, str | None]]:
+        futures = {executor.submit(run_buffered, *task): name for name, task in tasks.items()}
+        results = {}
+        for future in as_completed(futures):
+            duration, output, error = future.result()
+            lib.utils.print_header(name := futures[future])
+            print(output, end='', flush=True)
+            if error:
+                lib.utils.print_red(f"ERROR: {name} failed: {error}")
+            results[name] = (duration, error)
+        return results
+
+    with ProcessPoolExecutor(
+        max_workers=jobs or max(1, min(len(base_names), SOURCE_PREP_JOBS))
+    ) as executor:
+        fetches = run_all(
+            executor,
+            {
+                f"Updating {repo}": (update_remote, Path(os.environ['CBL_SRC_P'], trees[0]))
+                for repo, trees in repos.items()
+            },
+        )
+
+        tasks = {}
+        for repo, trees in repos.items():
+            if fetches[f"Updating {repo}"][1]:
+                failed += trees
             else:
-                lib.utils.call_git_loud(
-                    source_folder,
-                    ['revert', '--mainline', '1', '--no-edit', '--no-gpg-sign', revert],
-                )
+                tasks.update({tree: (prepare_source, tree, base_ref, False) for tree in trees})
 
-        for patch in patches:
-            am_cmd = ['am', '-3', '--no-gpg-sign']
-            am_kwargs = {}
-
-            if isinstance(patch, Path):
-                am_cmd.append(patch)
-            elif patch.startswith('https://lore.kernel.org/') and not patch.endswith('/raw'):
-                am_kwargs['input'] = b4_am_o(patch)
-            elif patch.startswith(('https://', 'http://')):
-                # curl is banned due to bot attacks
-                fetch_func = lib.utils.wget if 'lore.kernel.org' in patch else lib.utils.curl
-                am_kwargs['input'] = fetch_func(patch).decode('utf-8', 'ignore')
-            elif patch.lstrip().startswith('From ') and 'diff --git' in patch:
-                am_kwargs['input'] = patch
+        for base_name, (duration, error) in run_all(executor, tasks).items():
+            if error:
+                failed.append(base_name)
             else:
-                msg = f"Can't handle {patch}?"
-                raise RuntimeError(msg)
+                durations[base_name] = duration
 
-            lib.utils.call_git_loud(source_folder, am_cmd, **am_kwargs)
+    print()
+    for base_name, duration in durations.items():
+        lib.utils.print_green(
+            f"INFO: Prepared {base_name} in {lib.utils.get_duration(0, duration)}"
+        )
 
-        for commit in commits:
-            patch_input = lib.utils.call_git(
-                Path(os.environ['CBL_SRC_P'], 'linux-next'),
-                ['fp', '-1', '--stdout', commit],
-            ).stdout
-            lib.utils.call_git_loud(source_folder, ['am', '-3'], input=patch_input)
-    except CalledProcessError as err:
-        lib.utils.call_git(source_folder, 'ama', check=False)
-        print(f"\n[FAILED] {' '.join(err.cmd)}")
-        sys.exit(err.returncode)
+    if failed:
+        msg = f"Failed to prepare: {', '.join(failed)}"
+        raise RuntimeError(msg)
+
+    return durations
 
 
 # Basically '$binary --version | head -1'
@@ -220,6 +476,159 @@ def get_tool_version(binary_path: Path | str) -> str:
     return lib.utils.chronic([binary_path, '--version']).stdout.splitlines()[0]
 
 
+def get_build_db() -> Path:
+    return Path(
+        os.environ.get('XDG_DATA_FOLDER', Path.home().joinpath('.local/share')),
+        'kmake/builds.jsonl',
+    )
+
+
+def get_ccache_log_stats(stats_log: Path) -> dict[str, int]:
+    # With CCACHE_STATSLOG, ccache appends a '# <source file>' line for each
+    # compilation, followed by the counters that it updated, one per line.
+    # Using a private log for each build means that builds running at the same
+    # time are not counted in each other's statistics, unlike the counters of
+    # 'ccache --print-stats', which are for the whole cache.
+    try:
+        lines = stats_log.read_text(encoding='utf-8').splitlines()
+    # Nothing was compiled
+    except FileNotFoundError:
+        lines = []
+    return {
+        'hits': sum(line in {'direct_cache_hit', 'preprocessed_cache_hit'} for line in lines),
+        'misses': sum(line == 'cache_miss' for line in lines),
+    }
+
+
+def record_build(record: dict[str, Any]) -> None:
+    # Each build is one JSON object per line, so records can be appended
+    # without reading or rewriting the rest of the database. A single write()
+    # of each line with O_APPEND keeps records from concurrent builds intact.
+    build_db = get_build_db()
+    try:
+        build_db.parent.mkdir(exist_ok=True, parents=True)
+        with build_db.open('a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + '\n')
+    except OSError as err:
+        lib.utils.print_yellow(f"WARNING: Could not record build in {build_db}: {err}")
+
+
+def get_build_records(count: int = BUILD_RECORDS_READ) -> list[dict[str, Any]]:
+    if not (build_db := get_build_db()).exists():
+        return []
+    # The database is only ever appended to, so read blocks from the end of
+    # it until there are enough lines, rather than parsing all of it.
+    data = b''
+    with build_db.open('rb') as file:
+        pos = file.seek(0, os.SEEK_END)
+        while pos > 0 and data.count(b'\n') <= count:
+            block_size = min(pos, 64 * 1024)
+            pos -= block_size
+            file.seek(pos)
+            data = file.read(block_size) + data
+    records = []
+    for line in data.splitlines()[-count:]:
+        # Skip a partially written record from an interrupted build
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+def get_cgroups() -> list[Path]:
+    # Limits of all ancestors apply as well, so return the folders of our
+    # cgroup and all of its parents up to the root.
+    try:
+        cgroup = next(
+            line.removeprefix('0::')
+            for line in Path('/proc/self/cgroup').read_text(encoding='utf-8').splitlines()
+            if line.startswith('0::')
+        )
+    except (OSError, StopIteration):
+        return []
+    path = Path(CGROUP_ROOT, cgroup.strip().lstrip('/'))
+    return [path, *path.parents[: len(path.relative_to(CGROUP_ROOT).parts)]]
+
+
+def get_cpu_limit() -> int:
+    # CPUs that we are allowed to run on, which accounts for 'taskset' and
+    # the CPUs given to containers and virtual machines
+    cpus = len(os.sched_getaffinity(0))
+    for cgroup in get_cgroups():
+        # '<quota> <period>', where the quota is 'max' for no limit
+        if not (cpu_max := Path(cgroup, 'cpu.max')).exists():
+            continue
+        quota, period = cpu_max.read_text(encoding='utf-8').split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+    return cpus
+
+
+def get_mem_available() -> int:
+    # In kB, like /proc/meminfo
+    meminfo = Path('/proc/meminfo').read_text(encoding='utf-8')
+    if not (match := re.search(r'^MemAvailable:\s+(\d+) kB$', meminfo, flags=re.MULTILINE)):
+        msg = 'Could not find MemAvailable in /proc/meminfo?'
+        raise RuntimeError(msg)
+    mem_available = int(match.group(1))
+
+    # A memory limit on a cgroup may leave less memory to use than the
+    # system has available.
+    for cgroup in get_cgroups():
+        if not (memory_max := Path(cgroup, 'memory.max')).exists():
+            continue
+        if (limit := memory_max.read_text(encoding='utf-8').strip()) != 'max':
+            current = int(Path(cgroup, 'memory.current').read_text(encoding='utf-8'))
+            mem_available = min(mem_available, max(0, int(limit) - current) // 1024)
+    return mem_available
+
+
+def get_mem_peak(kernel_src: Path, out_dir: Path | None) -> int | None:
+    # The peak RSS of a build is that of its largest process, such as the
+    # linker with LTO or the compiler on the largest file. Only look at
+    # previous builds of the same output directory, as its configuration
+    # decides what is being built, and skip configuration only runs, which do
+    # not show the peak of a build.
+    key = ('o', str(out_dir)) if out_dir else ('source', str(kernel_src))
+    peaks = [
+        record['max_rss_kb']
+        for record in get_build_records()
+        if record.get(key[0]) == key[1]
+        and record.get('max_rss_kb')
+        and not (
+            record['targets'] and all(target.endswith('config') for target in record['targets'])
+        )
+    ]
+    return max(peaks[-MEM_ESTIMATE_BUILDS:]) if peaks else None
+
+
+def get_jobs(kernel_src: Path, out_dir: Path | None = None) -> tuple[int, str]:
+    # Pick a number of jobs that the CPUs we are allowed to use can run and
+    # that will fit in the available memory. Budget the peak that previous
+    # builds of the same configuration show for one job, as that is usually a
+    # serial step, and a typical compile job for the rest, so that the cap only
+    # kicks in when all of the jobs would not fit. Return the reason for the
+    # number, for the build log.
+    jobs = cpus = get_cpu_limit()
+    reason = f"{cpus} CPUs"
+    if mem_peak := get_mem_peak(kernel_src, out_dir):
+        mem_available = get_mem_available()
+        if job_mem_mb := os.environ.get('KMAKE_JOB_MEM_MB'):
+            job_mem = int(job_mem_mb) * 1024
+        else:
+            job_mem = COMPILE_JOB_MEM_KB
+        mem_needed = mem_peak + (cpus - 1) * job_mem
+        if mem_needed > mem_available:
+            jobs = max(1, 1 + (mem_available - mem_peak) // job_mem)
+            reason += (
+                f", {mem_available // 1024} MiB available for a "
+                f"{mem_peak // 1024} MiB peak from previous builds and "
+                f"{job_mem // 1024} MiB per other job"
+            )
+    return jobs, reason
+
+
 def kmake(
     variables: lib.utils.MakeVars,
     targets: list[str],
@@ -227,6 +636,8 @@ def kmake(
     directory: Path | None = None,
     env: lib.utils.EnvVars | lib.utils.MakeVars | None = None,
     jobs: int | None = None,
+    load_average: float | None = None,
+    log_file: Path | None = None,
     silent: bool = True,
     stdin: str | None = None,
     use_time: bool = False,
@@ -288,6 +699,7 @@ def kmake(
             lib.utils.print_yellow(
                 'WARNING: ccache requested by it could not be found, ignoring...'
             )
+            ccache = False
 
     # V=1 or V=2 should imply '-v'
     if 'V' in variables:
@@ -296,11 +708,20 @@ def kmake(
     flags = []
     if kernel_src.resolve() != Path.cwd():
         flags += ['-C', kernel_src]
-    flags += [f"-{'s' if silent else ''}kj{jobs or os.cpu_count()}"]
+    out_dir = Path(kernel_src, variables['O']).resolve() if 'O' in variables else None
+    if jobs:
+        jobs_reason = 'requested'
+    else:
+        jobs, jobs_reason = get_jobs(kernel_src.resolve(), out_dir)
+    flags += [f"-{'s' if silent else ''}kj{jobs}"]
+    if load_average:
+        flags += [f"-l{load_average:g}"]
 
     # Print information about current compiler
+    compiler_version = get_tool_version(compiler)
     lib.utils.print_green(f"\nCompiler location:\033[0m {compiler_location}\n")
-    lib.utils.print_green(f"Compiler version:\033[0m {get_tool_version(compiler)}\n")
+    lib.utils.print_green(f"Compiler version:\033[0m {compiler_version}\n")
+    lib.utils.print_green(f"Jobs:\033[0m {jobs} ({jobs_reason})\n")
 
     # Print information about the binutils being used, if they are being used
     # Account for implicit LLVM_IAS change in f12b034afeb3 ("scripts/Makefile.clang: default to LLVM_IAS=1")
@@ -347,10 +768,65 @@ def kmake(
             msg = 'Could not find time binary in PATH?'
             raise RuntimeError(msg)
         make_cmd = [gnu_time, '-v', *make_cmd]
-    else:
-        start_time = time.time()
+
+    # Give ccache a private statistics log for this build
+    if ccache:
+        stats_dir = TemporaryDirectory()
+        stats_log = Path(stats_dir.name, 'stats.log')
+        env = {**(env or {}), 'CCACHE_STATSLOG': str(stats_log)}
+
+    # The resource usage of make covers everything that it ran. The peak RSS
+    # is that of the largest single process, such as one compiler invocation
+    # or the final link.
+    rusages: list[resource.struct_rusage] = []
+    returncode = None
+    start_time = time.time()
     try:
-        lib.utils.run(make_cmd, env=env, stdin=stdin, show_cmd=True)
+        # Show the output as it happens while saving it to the log
+        if log_file:
+            lib.utils.run_streaming(
+                make_cmd,
+                callback=lambda line: print(line, end='', flush=True),
+                log_file=log_file,
+                rusage_callback=rusages.append,
+                env=env,
+                stdin=stdin,
+                show_cmd=True,
+            )
+        else:
+            lib.utils.run(
+                make_cmd, env=env, rusage_callback=rusages.append, stdin=stdin, show_cmd=True
+            )
+        returncode = 0
+    except CalledProcessError as err:
+        returncode = err.returncode
+        raise
     finally:
+        end_time = time.time()
+        if ccache:
+            ccache_stats = get_ccache_log_stats(stats_log)
+            stats_dir.cleanup()
+        else:
+            ccache_stats = None
         if not use_time:
-            print(f"\nTime: {lib.utils.get_duration(start_time)}")
+            print(f"\nTime: {lib.utils.get_duration(start_time, end_time)}")
+
+        record_build(
+            {
+                'start': start_time,
+                'wall': end_time - start_time,
+                'user': rusages[0].ru_utime if rusages else None,
+                'sys': rusages[0].ru_stime if rusages else None,
+                'max_rss_kb': rusages[0].ru_maxrss if rusages else None,
+                'ccache': ccache_stats,
+                'returncode': returncode,
+                'source': str(kernel_src.resolve()),
+                'arch': variables.get('ARCH', os.uname().machine),
+                'o': str(out_dir) if out_dir else None,
+                'targets': targets,
+                'jobs': jobs,
+                'compiler': str(compiler),
+                'compiler_version': compiler_version,
+                'hostname': socket.gethostname(),
+            }
+        )
@@ -3,7 +3,14 @@
 # Copyright (C) 2022-2023 Nathan Chancellor
 
 import hashlib
+import json
+import mmap
+import os
 import re
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 from pathlib import Path
 
 # Anything that imports this will need to use uv
@@ -11,28 +18,154 @@ import requests
 
 from . import utils
 
+# Large reads amortize the round trips to network filesystems
+BUFFER_SIZE = 8 * 1048576  # 8MB at a time
+NETWORK_FILESYSTEMS = ('9p', 'cifs', 'fuse.sshfs', 'nfs', 'nfs4', 'smb3', 'virtiofs')
 
-def calculate(file_path: Path) -> str:
-    file_hash = hashlib.sha256()
+# Checksum manifests that have been fetched during this run, keyed by URL,
+# along with a lock for each URL so that each manifest is only fetched once.
+# MANIFESTS_LOCK only guards these dictionaries and is never held while
+# fetching a manifest.
+MANIFESTS: dict[str, dict[str, str]] = {}
+MANIFEST_LOCKS: dict[str, threading.Lock] = {}
+MANIFESTS_LOCK = threading.Lock()
+
+
+@cache
+def is_network_device(st_dev: int) -> bool:
+    dev = f"{os.major(st_dev)}:{os.minor(st_dev)}"
+    for line in Path('/proc/self/mountinfo').read_text(encoding='utf-8').splitlines():
+        # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        fields, fs_info = line.split(' - ', 1)
+        if fields.split(' ')[2] == dev:
+            return fs_info.split(' ', 1)[0] in NETWORK_FILESYSTEMS
+    return False
+
+
+def calculate(file_path: Path, algorithm: str = 'sha256') -> str:
+    file_hash = hashlib.new(algorithm)
     with Path(file_path).open('rb') as file:
-        # 1MB at a time
-        while chunk := file.read(1048576):  # 1MB at a time
-            file_hash.update(chunk)
+        file_stat = os.fstat(file.fileno())
+
+        # Hashing a mapping of a local file avoids copying it into a buffer
+        # but faulting in pages over the network is much slower than large
+        # reads, so only do it for local files.
+        if file_stat.st_size and not is_network_device(file_stat.st_dev):
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                file_hash.update(file_map)
+        else:
+            buffer = memoryview(bytearray(BUFFER_SIZE))
+            while size := file.readinto(buffer):
+                file_hash.update(buffer[:size])
     return file_hash.hexdigest()
 
 
+def calculate_many(
+    files: Iterable[Path],
+    algorithm: str = 'sha256',
+    jobs: int | None = None,
+) -> dict[Path, str]:
+    if not (files := list(files)):
+        return {}
+
+    # hashlib drops the GIL while hashing, so threads scale across cores
+    with ThreadPoolExecutor(max_workers=jobs or min(len(files), os.cpu_count() or 1)) as executor:
+        hashes = executor.map(calculate, files, [algorithm] * len(files))
+        return dict(zip(files, hashes, strict=True))
+
+
+def get_manifest_cache(url: str) -> Path:
+    cache_folder = Path(
+        os.environ.get('XDG_CACHE_FOLDER', Path.home().joinpath('.cache')), 'sha256_manifests'
+    )
+    return Path(cache_folder, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json")
+
+
+def parse_manifest(manifest: str) -> dict[str, str]:
+    digests: dict[str, str] = {}
+    for line in manifest.splitlines():
+        if not (sha256_match := re.search(r'[A-Fa-f0-9]{64}', line)):
+            continue
+        # BSD style: 'SHA256 (<file>) = <digest>'
+        if bsd_match := re.match(r'SHA256 \((.+)\) = ', line):
+            name = bsd_match.group(1)
+        # GNU style: '<digest>  <file>' or '<digest> *<file>' for binary mode
+        else:
+            name = (line[: sha256_match.start()] + line[sha256_match.end() :]).strip().lstrip('*')
+        if name:
+            digests.setdefault(name.rsplit('/', 1)[-1], sha256_match.group(0))
+    return digests
+
+
+def get_manifest(url: str) -> dict[str, str]:
+    # Several files are often validated against the same manifest, possibly
+    # from multiple threads, so only fetch each one once per run.
+    with MANIFESTS_LOCK:
+        if url in MANIFESTS:
+            return MANIFESTS[url]
+        url_lock = MANIFEST_LOCKS.setdefault(url, threading.Lock())
+
+    # Different manifests are fetched at the same time, while other threads
+    # that need this manifest wait for the first one to fetch it.
+    with url_lock:
+        with MANIFESTS_LOCK:
+            if url in MANIFESTS:
+                return MANIFESTS[url]
+
+        cache_file = get_manifest_cache(url)
+        cached = json.loads(cache_file.read_text(encoding='utf-8')) if cache_file.exists() else {}
+
+        # Avoid downloading the manifest again if it has not changed since the
+        # last run.
+        headers = {}
+        if etag := cached.get('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := cached.get('last_modified'):
+            headers['If-Modified-Since'] = last_modified
+
+        response = requests.get(url, headers=headers, timeout=3600)
+        response.raise_for_status()
+
+        if response.status_code == requests.codes.not_modified:
+            digests = cached['digests']
+        else:
+            digests = parse_manifest(response.content.decode('utf-8'))
+            if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+                cache_file.parent.mkdir(exist_ok=True, parents=True)
+                tmp_cache_file = cache_file.with_name(f"{cache_file.name}.tmp")
+                tmp_cache_file.write_text(
+                    json.dumps(
+                        {
+                            'digests': digests,
+                            'etag': response.headers.get('ETag'),
+                            'last_modified': response.headers.get('Last-Modified'),
+                            'url': url,
+                        },
+                        indent=4,
+                    ),
+                    encoding='utf-8',
+                )
+                tmp_cache_file.replace(cache_file)
+
+        with MANIFESTS_LOCK:
+            MANIFESTS[url] = digests
+
+    return digests
+
+
 def get_from_url(url: str, basename: str) -> str | None:
-    response = requests.get(url, timeout=3600)
-    response.raise_for_status()
-    for line in response.content.decode('utf-8').splitlines():
-        if 'clone.bundle' in basename:
-            basename = basename.split('-', maxsplit=1)[0]
-        if basename in line and (sha256_match := re.search(r'[A-Fa-f0-9]{64}', line)):
-            return sha256_match.group(0)
-    return None
+    if 'clone.bundle' in basename:
+        basename = basename.split('-', maxsplit=1)[0]
 
+    digests = get_manifest(url)
+    if sha256 := digests.get(basename):
+        return sha256
+    # Fall back to matching a part of the name, which is needed for the
+    # clone.bundle case above.
+    return next((sha256 for name, sha256 in digests.items() if basename in name), None)
 
-def validate_from_url(file: Path, url: str):
+
+def validate_from_url(file: Path, url: str) -> str:
     computed_sha256 = calculate(file)
     expected_sha256 = get_from_url(url, file.name)
 
@@ -41,3 +174,5 @@ def validate_from_url(file: Path, url: str):
     else:
         msg = f"{file.name} computed checksum ('{computed_sha256}') did not match expected checksum ('{expected_sha256}')!"
         raise RuntimeError(msg)
+
+    return computed_sha256
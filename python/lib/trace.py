@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import atexit
+import glob
+import json
+import operator
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable
+from functools import cache, wraps
+from pathlib import Path
+
+# Setting this to a file path enables tracing of all commands that are run
+# through lib.utils.run(), which writes a Chrome Trace Event JSON file to that
+# path and a summary of the slowest commands to stderr when the script exits.
+# The trace can be loaded in chrome://tracing or https://ui.perfetto.dev.
+# Commands that are run by child processes, such as other scripts or the
+# workers of a ProcessPoolExecutor, are included in the same trace.
+TRACE_FILE_VAR = 'CMD_TRACE_FILE'
+# The process ID of the process that enabled tracing, which is set for its
+# child processes so that only it writes the trace
+TRACE_ROOT_VAR = 'CMD_TRACE_ROOT'
+SUMMARY_LENGTH = 15
+
+
+def get_cmd_name(cmd: list[str]) -> str:
+    # Group commands by their program and for programs with subcommands, the
+    # subcommand, skipping over privilege escalation.
+    if cmd and cmd[0] in {'doas', 'sudo'}:
+        cmd = cmd[1:]
+    if not cmd:
+        return ''
+    name = Path(cmd[0]).name
+    if name in {'b4', 'git', 'podman', 'systemctl'} and len(cmd) > 1:
+        # Skip over options before the subcommand, such as 'git -C <dir>'
+        args = iter(cmd[1:])
+        for arg in args:
+            if arg == '-C':
+                next(args, None)
+            elif not arg.startswith('-'):
+                return f"{name} {arg}"
+    return name
+
+
+def get_summary(events: list[dict]) -> str:
+    durations: dict[str, list[float]] = {}
+    for event in events:
+        durations.setdefault(event['name'], []).append(event['dur'] / 1000000)
+    totals = sorted(
+        ((sum(values), max(values), len(values), name) for name, values in durations.items()),
+        reverse=True,
+    )
+
+    lines = [
+        f"{len(events)} commands took {sum(item[0] for item in totals):.3f}s",
+        '',
+        f"{'command':<30} {'count':>7} {'total':>10} {'max':>10}",
+    ]
+    lines += [
+        f"{name[:30]:<30} {count:>7} {total:>9.3f}s {longest:>9.3f}s"
+        for total, longest, count, name in totals[:SUMMARY_LENGTH]
+    ]
+    return '\n'.join(lines)
+
+
+class CmdTracer:
+    def __init__(self, trace_file: Path) -> None:
+        self.trace_file: Path = trace_file
+
+    def get_parts(self) -> list[Path]:
+        return sorted(self.trace_file.parent.glob(f"{glob.escape(self.trace_file.name)}.*.jsonl"))
+
+    def record(
+        self,
+        cmd: list[str],
+        cwd: str | None,
+        start: float,
+        end: float,
+        returncode: int | None,
+    ) -> None:
+        event = {
+            'name': get_cmd_name(cmd),
+            'cat': 'cmd',
+            'ph': 'X',
+            'ts': start * 1000000,
+            'dur': (end - start) * 1000000,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': {
+                'cmd': cmd,
+                'cwd': cwd or str(Path.cwd()),
+                'returncode': returncode,
+            },
+        }
+        # Append each event to a file for this process as soon as it happens,
+        # as the workers of a ProcessPoolExecutor exit without running atexit
+        # handlers. A single write() with O_APPEND is not interleaved with the
+        # writes of other threads.
+        part = self.trace_file.with_name(f"{self.trace_file.name}.{os.getpid()}.jsonl")
+        fd = os.open(part, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(event) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def write(self) -> None:
+        # Forked processes inherit the atexit handler of the process that
+        # enabled tracing, which is the only one that writes the trace.
+        if os.environ.get(TRACE_ROOT_VAR) != str(os.getpid()):
+            return
+
+        events = []
+        for part in self.get_parts():
+            for line in part.read_text(encoding='utf-8').splitlines():
+                # Skip an event that a killed process did not finish writing
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+            part.unlink()
+        if not events:
+            return
+
+        events.sort(key=operator.itemgetter('ts'))
+        self.trace_file.write_text(
+            json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}), encoding='utf-8'
+        )
+        print(
+            f"\n{get_summary(events)}\n\nCommand trace written to {self.trace_file}",
+            file=sys.stderr,
+        )
+
+
+@cache
+def get_tracer() -> CmdTracer:
+    # All traced functions share one tracer so they end up in the same trace.
+    # Child processes may run in a different folder, so pass them an absolute
+    # path.
+    trace_file = Path(os.environ[TRACE_FILE_VAR]).resolve()
+    os.environ[TRACE_FILE_VAR] = str(trace_file)
+    tracer = CmdTracer(trace_file)
+
+    # The first process to trace commands collects the events of all of its
+    # child processes, which inherit the environment, when it exits.
+    if not os.environ.get(TRACE_ROOT_VAR):
+        os.environ[TRACE_ROOT_VAR] = str(os.getpid())
+        trace_file.parent.mkdir(exist_ok=True, parents=True)
+        # Remove the events of a previous run that did not finish
+        for part in tracer.get_parts():
+            part.unlink()
+        atexit.register(tracer.write)
+    return tracer
+
+
+def trace_run(
+    run: Callable[..., subprocess.CompletedProcess],
+) -> Callable[..., subprocess.CompletedProcess]:
+    # Only called when tracing is enabled so there is no cost when it is not
+    tracer = get_tracer()
+
+    @wraps(run)
+    def traced_run(args, **kwargs) -> subprocess.CompletedProcess:
+        cmd = (
+            [os.fsdecode(args)]
+            if isinstance(args, (str, bytes, os.PathLike))
+            else [os.fsdecode(arg) for arg in args]
+        )
+        cwd = os.fsdecode(cwd) if (cwd := kwargs.get('cwd')) else None
+        returncode = None
+        start = time.time()
+        try:
+            result = run(args, **kwargs)
+            returncode = result.returncode
+        except subprocess.CalledProcessError as err:
+            returncode = err.returncode
+            raise
+        finally:
+            tracer.record(cmd, cwd, start, time.time(), returncode)
+        return result
+
+    return traced_run
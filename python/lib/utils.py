@@ -6,16 +6,21 @@ import copy
 import getpass
 import json
 import os
+import resource
 import shlex
 import shutil
 import socket
 import subprocess
 import sys
 import time
-from collections.abc import Sequence
+from collections import deque
+from collections.abc import Callable, Sequence
+from contextlib import ExitStack
 from pathlib import Path
 from typing import Any, TypedDict
 
+from . import trace
+
 PathString = Path | str
 ValidSingleCmd = str | bytes | os.PathLike
 ValidCmd = ValidSingleCmd | Sequence[ValidSingleCmd]
@@ -46,6 +51,26 @@ class MakeVars(TypedDict, total=False):
     RPMOPTS: str
 
 
+class OutputTail:
+    # Keeps only the last max_size bytes (approximately, as characters) of
+    # the lines that are added to it, for showing the end of long output.
+
+    def __init__(self, max_size: int = 64 * 1024) -> None:
+        self.max_size: int = max_size
+        self.lines: deque[str] = deque()
+        self.size: int = 0
+
+    def append(self, line: str) -> None:
+        self.lines.append(line)
+        self.size += len(line)
+        # Always keep the last line, even if it is larger than max_size
+        while self.size > self.max_size and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+
+    def get(self) -> str:
+        return ''.join(self.lines)
+
+
 def call_git(directory: Path | None, cmd: ValidCmd, **kwargs) -> subprocess.CompletedProcess:
     kwargs.setdefault('cwd', directory)
 
@@ -272,6 +297,16 @@ def request_root(msg: str) -> None:
     run0('true')
 
 
+def wait_rusage(proc: subprocess.Popen) -> resource.struct_rusage:
+    # Popen.wait() does not return the resource usage of the process, so reap
+    # it with os.wait4() instead, which covers the process and all of the
+    # processes that it waited on, such as the jobs of make. Popen.wait() then
+    # returns the exit status saved here.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
 def run(args: ValidCmd, **kwargs) -> subprocess.CompletedProcess:
     kwargs.setdefault('check', True)
 
@@ -287,6 +322,17 @@ def run(args: ValidCmd, **kwargs) -> subprocess.CompletedProcess:
     if env := kwargs.pop('env', None):
         kwargs['env'] = os.environ | copy.deepcopy(env)
 
+    # subprocess.run() waits for the command itself, so run it directly to pass
+    # its resource usage to the callback, which does not support capturing
+    # output or input.
+    if rusage_callback := kwargs.pop('rusage_callback', None):
+        check = kwargs.pop('check')
+        with subprocess.Popen(args, **kwargs) as proc:
+            rusage_callback(wait_rusage(proc))
+        if check and proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        return subprocess.CompletedProcess(args, proc.returncode)
+
     try:
         # This function defaults check=True so if check=False here, it is explicit
         return subprocess.run(args, **kwargs)  # ruff:ignore[subprocess-run-without-check]
@@ -315,6 +361,62 @@ def run_check_rc_zero(args: ValidCmd, **kwargs) -> bool:
     return chronic(args, **kwargs, check=False).returncode == 0
 
 
+def run_streaming(
+    args: ValidCmd,
+    callback: Callable[[str], None] | None = None,
+    log_file: Path | None = None,
+    tail_size: int = 64 * 1024,
+    rusage_callback: Callable[[resource.struct_rusage], None] | None = None,
+    **kwargs,
+) -> subprocess.CompletedProcess:
+    # Like chronic() but without holding all of the output of a command in
+    # memory. stdout and stderr are combined and each line is passed to
+    # callback (if any) and written to log_file (if any) as soon as it is
+    # printed. Only the last tail_size bytes of output are kept, which become
+    # the stdout of the returned object and are printed if the command fails
+    # without a callback to show the output otherwise. The resource usage of
+    # the command is passed to rusage_callback (if any) once it exits.
+    check = kwargs.pop('check', True)
+
+    if (show_cmd_location := kwargs.pop('show_cmd_location', False)) or kwargs.pop(
+        'show_cmd', False
+    ):
+        print_cmd(args, show_cmd_location=show_cmd_location)
+
+    if env := kwargs.pop('env', None):
+        kwargs['env'] = os.environ | copy.deepcopy(env)
+
+    tail = OutputTail(tail_size)
+    with ExitStack() as stack:
+        log = stack.enter_context(log_file.open('w', encoding='utf-8')) if log_file else None
+        proc = stack.enter_context(
+            subprocess.Popen(
+                args,
+                bufsize=1,
+                errors='replace',
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE,
+                text=True,
+                **kwargs,
+            )
+        )
+        for line in proc.stdout:  # ty: ignore[not-iterable]
+            tail.append(line)
+            if log:
+                log.write(line)
+            if callback:
+                callback(line)
+        if rusage_callback:
+            rusage_callback(wait_rusage(proc))
+
+    if check and proc.returncode:
+        if not callback:
+            print(tail.get())
+        raise subprocess.CalledProcessError(proc.returncode, args, output=tail.get())
+
+    return subprocess.CompletedProcess(args, proc.returncode, stdout=tail.get())
+
+
 def systemd_drop_in(service: str, drop_in_name: str, conf_txt: str) -> subprocess.CompletedProcess:
     return run0(
         ['systemctl', 'edit', '--stdin', '--drop-in', drop_in_name, service],
@@ -373,3 +475,10 @@ def wget(item_to_download, output=None) -> bytes:
         item_to_download,
     ]
     return chronic(wget_cmd, text=None).stdout
+
+
+# Wrap run() rather than checking the environment in it so that there is no
+# overhead when tracing is disabled.
+if os.environ.get(trace.TRACE_FILE_VAR):
+    run = trace.trace_run(run)
+    run_streaming = trace.trace_run(run_streaming)
@@ -9,6 +9,7 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
+import lib.git
 import lib.utils
 
 NSPAWN_MACH_NAME = 'pgo-llvm-builder'
@@ -272,8 +273,14 @@ if __name__ == '__main__':
                 raise RuntimeError(msg)
             llvm_ref = match.groups()[0]
             # Next, we need to see what version this actually is
-            show_cmd = ['show', f"{llvm_ref}:cmake/Modules/LLVMVersion.cmake"]
-            llvm_version_cmake_txt = lib.utils.call_git(llvm_folder, show_cmd).stdout
+            llvm_version_cmake_path = 'cmake/Modules/LLVMVersion.cmake'
+            if (
+                llvm_version_cmake_txt := lib.git.get_query(llvm_folder).show_file(
+                    llvm_ref, llvm_version_cmake_path
+                )
+            ) is None:
+                msg = f"{llvm_version_cmake_path} could not be found at {llvm_ref}?"
+                raise RuntimeError(msg)
             if (
                 len(
                     matches := re.findall(
@@ -293,9 +300,11 @@ if __name__ == '__main__':
 
         if 'llvmorg' not in llvm_ref:
             date_info = datetime.datetime.now(datetime.UTC).strftime('%Y%m%d-%H%M%S')
-            llvm_ref_info = lib.utils.get_git_output(
-                llvm_folder, ['show', '--format=%H', '-s', llvm_ref]
-            )
+            if not (
+                llvm_ref_info := lib.git.get_query(llvm_folder).rev_parse(f"{llvm_ref}^{{commit}}")
+            ):
+                msg = f"{llvm_ref} could not be found in {llvm_folder}?"
+                raise RuntimeError(msg)
             llvm_version += f"-{llvm_ref_info}-{date_info}"
 
         if (
@@ -8,6 +8,7 @@ from pathlib import Path
 from subprocess import PIPE, Popen
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
+import lib.git
 import lib.kernel
 import lib.utils
 
@@ -65,12 +66,9 @@ def gen_b4_branches(b4_branches: Iterable[str], b4_tags: Iterable[str]) -> Branc
 
 
 def get_b4_branches(directory: Path) -> Branches:
-    b4_branches = lib.utils.get_git_output(
-        directory, ['for-each-ref', '--format=%(refname:short)', 'refs/heads/b4/']
-    ).splitlines()
-    b4_tags = lib.utils.get_git_output(
-        directory, ['for-each-ref', '--format=%(refname:short)', 'refs/tags/sent/']
-    ).splitlines()
+    query = lib.git.get_query(directory)
+    b4_branches = [branch for branch in query.get_refs('refs/heads/') if branch.startswith('b4/')]
+    b4_tags = [tag for tag in query.get_refs('refs/tags/') if tag.startswith('sent/')]
     return gen_b4_branches(b4_branches, b4_tags)
 
 
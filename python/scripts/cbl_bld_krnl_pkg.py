@@ -19,6 +19,7 @@ import korg_tc
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import lib.kernel
+import lib.sha256
 import lib.utils
 
 CONFIG_URL = (
@@ -168,12 +169,9 @@ class KernelPkgBuilder:
             msg = f"More than one .tar.zst found? {pkg_tar_zst}"
             raise RuntimeError(msg)
         (b2sum_file := Path(self._build_folder, 'b2sum')).unlink(missing_ok=True)
-        b2sum_txt = lib.utils.chronic(
-            [
-                'b2sum',
-                pkg_tar_zst[0].resolve(),
-            ]
-        ).stdout.replace('/run/host', '')
+        # Matches the output of 'b2sum'
+        b2sum = lib.sha256.calculate(pkg_tar := pkg_tar_zst[0].resolve(), 'blake2b')
+        b2sum_txt = f"{b2sum}  {pkg_tar}\n".replace('/run/host', '')
         b2sum_file.write_text(b2sum_txt, encoding='utf-8')
 
     def package(self) -> None:
@@ -259,8 +257,9 @@ package() {{
         localmodconfig: bool = False,
         menuconfig: bool = False,
         extra_config_targets: list[str] | None = None,
+        update: bool = True,
     ) -> None:
-        lib.kernel.prepare_source(self._pkgname, base_ref)
+        lib.kernel.prepare_source(self._pkgname, base_ref, update)
 
         self._prepare_files(localmodconfig, menuconfig, extra_config_targets)
 
@@ -374,6 +373,12 @@ def parse_arguments():
 
     parser.add_argument('--no-rust', action='store_true', help='Disable CONFIG_RUST')
 
+    parser.add_argument(
+        '--no-update',
+        action='store_true',
+        help='Do not update the source tree before preparing it (e.g. after cbl_prep_krnl_srcs)',
+    )
+
     parser.add_argument(
         '-R', '--ref', default='origin/master', help='Reference to base kernel tree on'
     )
@@ -440,7 +445,9 @@ if __name__ == '__main__':
         del builder.make_variables['LLVM']
     builder.make_variables.update(make_vars)
 
-    builder.prepare(args.ref, args.localmodconfig, args.menuconfig, config_targets)
+    builder.prepare(
+        args.ref, args.localmodconfig, args.menuconfig, config_targets, not args.no_update
+    )
     builder.build()
     builder.package()
     builder.gen_b2sum()
@@ -2,10 +2,19 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2022-2023 Nathan Chancellor
 
+import gzip
+import lzma
+import os
 import re
+import sqlite3
+import subprocess
 import sys
 from argparse import ArgumentParser
+from collections.abc import Generator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import TextIO
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import lib.utils
@@ -13,12 +22,194 @@ import lib.utils
 Warnings = list[str]
 WarningsDict = dict[str, Warnings]
 
+# Lines that contain any of these are considered problems
+SEARCHES: Warnings = [
+    'error:',
+    'Error:',
+    'ERROR:',
+    'FAILED:',
+    'FATAL:',
+    'undefined',
+    'Unsupported relocation type:',
+    'warning:',
+    'Warning:',
+    'WARNING:',
+]  # fmt: off
+PROBLEM_RE = re.compile('|'.join(SEARCHES))
+
+# Filter warnings based on priority to fix
+MERGE_CONFIG_IGNORE: Warnings = [
+    'CPU_BIG_ENDIAN',
+    'LTO_CLANG_THIN',
+    'PREEMPT',
+    'SQUASHFS_DECOMP_SINGLE',
+    'SQUASHFS_DECOMP_MULTI',
+    'SQUASHFS_DECOMP_MULTI_PERCPU',
+]
+IGNORE: Warnings = [
+    # Too many to deal with for now
+    'objtool:',
+    '-Wframe-larger-than',
+    # Warnings from merge_config that are harmless
+    f"override: ({'|'.join(MERGE_CONFIG_IGNORE)}) changes choice state",
+    # https://github.com/ClangBuiltLinux/linux/issues/1065
+    r'union jset::\(anonymous at ./usr/include/linux/bcache.h:',
+    # https://github.com/ClangBuiltLinux/linux/issues/1427
+    "llvm-objdump: error: 'vmlinux': not a dynamic object",
+    # https://github.com/ClangBuiltLinux/linux/issues/1315
+    "unused during compilation: '-march=arm",
+    # https://github.com/ClangBuiltLinux/linux/issues/1555
+    r"scripts/(extract-cert|sign-file).c:[0-9]+:[0-9]+: warning: '(ENGINE|ERR)_.*' is deprecated \[-Wdeprecated-declarations\]",
+    # New binutils warnings that are not clang specific:
+    # https://sourceware.org/bugzilla/show_bug.cgi?id=29072
+    'missing .note.GNU-stack section implies executable stack',
+    r'requires executable stack \(because the .note.GNU-stack section is executable\)',
+    'has a LOAD segment with RWX permissions',
+    # https://github.com/llvm/llvm-project/issues/59037
+    'error: write on a pipe with no reader',
+    # https://github.com/ClangBuiltLinux/linux/issues/1415
+    '(asmmacro.h|genex.S|[0-9]+):.*macro defined with named parameters',
+    'macro local_irq_enable reg=',
+    # new warning present with make 4.4:
+    # https://lore.kernel.org/Y7i8+EjwdnhHtlrr@dev-arch.thelio-3990X/
+    'llvm-nm: error: arch/arm/boot/compressed/../../../../vmlinux: No such file or directory',
+    # Ignore all objdump warnings, most are from tool incompatibilities like DWARF5 handling
+    'gnu-objdump: Warning:',
+    # QEMU warnings, generally not useful
+    'qemu-system-[a-z0-9]+: warning:',
+    # QEMU warning for PowerPC on kernels prior to e4bb64c7a42e ("powerpc:
+    # remove interrupt handler functions from the noinstr section") in
+    # 5.12, backport is too hairy, just ignore.
+    r"WARNING: CPU: [0-9]+ PID: [0-9]+ at arch/powerpc/kernel/optprobes.c:[0-9]+ kretprobe_trampoline\+",
+    # Warning on boot when SRSO is not set, which is not really a problem
+    # for our simple QEMU boots.
+    'kernel not compiled with (CPU|MITIGATION)_SRSO',
+    # Warning when SRSO is missing some option, harmless for our quick and
+    # simple QEMU boots.
+    'See https://kernel.org/doc/html/latest/admin-guide/hw-vuln/srso.html for mitigation options.',
+    # Warning when CONFIG_NTFS3_64BIT_CLUSTER is enabled, which we do not
+    # care about at all.
+    'Activated 64 bits per cluster. Windows does not support this',
+    # Python 3.12 warnings, not ClangBuiltLinux related
+    'SyntaxWarning: invalid escape sequence',
+    # Warning from LoongArch firmware, who cares?
+    'Error: Image at [0-9A-F]+ start failed: Not Found',
+    # Harmless warning from LoongArch with newer version of QEMU and old version of defconfig
+    'Warning: Processor Platform Limit event detected, but not handled',
+    # New modpost warnings (may be upgraded to errors eventually)
+    'WARNING: modpost: missing MODULE_DESCRIPTION',
+    # Warning/error from rustc, hide because other errors/warnings will be shown
+    r"warning: \d+ warnings? emitted",
+    r"error: aborting due to \d+ previous errors",
+    # Known warning from rustc on s390
+    # https://lore.kernel.org/20260615164013.GA249489@ax162/
+    'warning: unstable feature specified for `-Ctarget-feature`: `backchain`',
+    # Known warnings from rustc on powerpc
+    # https://lore.kernel.org/20260804202217.GA1109939@ax162/
+    r"warning: (unknown and )?unstable feature specified for `-Ctarget-feature`: `(altivec|hard-float|mma|vsx)`",
+]
+IGNORE_RE = re.compile('|'.join(IGNORE))
+
+# Compressed logs that can be read transparently, in order of preference
+COMPRESSED_EXTS = ('.zst', '.xz', '.gz')
+INTERNAL_LOGS = ('failed', 'info', 'skipped', 'success')
+
+# Parts of a warning that change between runs without the warning itself
+# changing, which are stripped to generate its fingerprint
+FINGERPRINT_SUBS = [
+    # Directories leading up to a file name
+    (re.compile(r'(?:[\w.+-]+/)+'), ''),
+    # Line and column numbers
+    (re.compile(r':\d+(?::\d+)?(?=[:\s]|$)'), ''),
+    # Addresses and offsets
+    (re.compile(r'0x[0-9a-fA-F]+'), '0x'),
+]
+
+
+class WarningIndex:
+    def __init__(self, index_file: Path) -> None:
+        index_file.parent.mkdir(exist_ok=True, parents=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(index_file)
+        self.connection.executescript(
+            '''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS warnings (
+                tree TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                first_run TEXT NOT NULL,
+                last_run TEXT NOT NULL,
+                PRIMARY KEY (tree, fingerprint)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS warnings_first_run ON warnings (tree, first_run);
+            '''
+        )
+
+    @staticmethod
+    def get_fingerprint(warning: str) -> str:
+        for regex, replacement in FINGERPRINT_SUBS:
+            warning = regex.sub(replacement, warning)
+        return warning.strip()
+
+    def update(self, tree: str, run: str, warnings: Warnings) -> Warnings:
+        fingerprints = {warning: self.get_fingerprint(warning) for warning in warnings}
+
+        # Run names start with the tree name and end with the date and time
+        # they were started at, so they sort chronologically, which allows
+        # older runs to be indexed after newer ones and the same run to be
+        # indexed multiple times.
+        with self.connection:
+            self.connection.executemany(
+                '''
+                INSERT INTO warnings (tree, fingerprint, first_run, last_run)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (tree, fingerprint) DO UPDATE SET
+                    first_run = min(first_run, excluded.first_run),
+                    last_run = max(last_run, excluded.last_run)
+                ''',
+                [(tree, fingerprint, run, run) for fingerprint in set(fingerprints.values())],
+            )
+            new = {
+                fingerprint
+                for (fingerprint,) in self.connection.execute(
+                    'SELECT fingerprint FROM warnings WHERE tree = ? AND first_run = ?',
+                    (tree, run),
+                )
+            }
+
+        return [warning for warning, fingerprint in fingerprints.items() if fingerprint in new]
+
+    def close(self) -> None:
+        self.connection.close()
+
 
 def parse_arguments():
     parser = ArgumentParser(
         description='Prepare an email build report from build logs generated with cbl_lkt'
     )
 
+    parser.add_argument(
+        '-c',
+        '--compress',
+        action='store_true',
+        help='Compress logs with zstd after generating the report',
+    )
+    parser.add_argument(
+        '-i',
+        '--index-file',
+        default=Path(
+            os.environ.get('XDG_DATA_FOLDER', Path.home().joinpath('.local/share')),
+            'cbl_gen_build_report/warnings.db',
+        ),
+        type=Path,
+        help='Database to record warnings seen in each run in (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-n',
+        '--new-only',
+        action='store_true',
+        help='Add a section with warnings not seen in a previous run of the same tree',
+    )
     parser.add_argument(
         '-p',
         '--print-to-stdout',
@@ -30,126 +221,120 @@ def parse_arguments():
     return parser.parse_args()
 
 
+def get_log_name(log: Path) -> str:
+    # Compressed logs are reported under their uncompressed name so that the
+    # report is the same regardless of whether a folder has been compressed.
+    return log.name.removesuffix(log.suffix) if log.suffix in COMPRESSED_EXTS else log.name
+
+
+def get_log_preference(log: Path) -> int:
+    # Uncompressed logs first, then compressed logs in order of preference
+    return COMPRESSED_EXTS.index(log.suffix) + 1 if log.suffix in COMPRESSED_EXTS else 0
+
+
 def get_log(log_folder: Path, key: str) -> Path:
-    return Path(log_folder, key + '.log')
+    log = Path(log_folder, key + '.log')
+    if log.exists():
+        return log
+    return next(
+        (
+            compressed_log
+            for ext in COMPRESSED_EXTS
+            if (compressed_log := log.with_name(log.name + ext)).exists()
+        ),
+        log,
+    )
+
+
+@contextmanager
+def open_log(log: Path) -> Generator[TextIO]:
+    if log.suffix == '.gz':
+        with gzip.open(log, 'rt', encoding='utf-8') as file:
+            yield file
+    elif log.suffix == '.xz':
+        with lzma.open(log, 'rt', encoding='utf-8') as file:
+            yield file
+    elif log.suffix == '.zst':
+        # zstd is not in the standard library until Python 3.14 so decompress
+        # through a pipe, which also moves decompression off of this process.
+        with subprocess.Popen(
+            ['zstd', '--decompress', '--quiet', '--stdout', log],
+            encoding='utf-8',
+            stdout=subprocess.PIPE,
+        ) as proc:
+            yield proc.stdout  # ty: ignore[invalid-yield]
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    else:
+        with log.open(encoding='utf-8') as file:
+            yield file
+
+
+def read_log(log: Path) -> str:
+    with open_log(log) as file:
+        return file.read()
+
+
+def compress_logs(log_folder: Path) -> None:
+    if not (logs := sorted(log_folder.glob('*.log'))):
+        return
+    # zstd only removes each log once it has been compressed successfully.
+    # Overwrite a compressed copy left behind by an interrupted run, as the
+    # uncompressed log is the complete one.
+    lib.utils.run(['zstd', '--force', '--quiet', '--rm', '-T0', *logs])
+    lib.utils.print_green(f"INFO: Compressed {len(logs)} logs in {log_folder}")
+
+
+def scan_log(log: Path, src_folder: Path) -> tuple[str, Warnings, Warnings]:
+    full: set[str] = set()
+    filtered: set[str] = set()
+    # Stream the log line by line rather than reading it all into memory, as
+    # logs can be quite large, and filter each problem as it is found.
+    # Compressed logs are decompressed as they are read.
+    with open_log(log) as file:
+        for line in file:
+            # We specifically check "dodgy linker" because this is known to be
+            # extremely noisy and will appear with most released versions of
+            # clang. They will still appear in the log files but they do not
+            # need to be logged in these reports.
+            if not PROBLEM_RE.search(line) or 'dodgy linker' in line:
+                continue
+            full.add(problem := line.replace(f"{src_folder}/", ''))
+            if not IGNORE_RE.search(problem):
+                filtered.add(problem)
+    return get_log_name(log), sorted(full), sorted(filtered)
 
 
 def generate_warnings(
     log_folder: Path, src_folder: Path
 ) -> tuple[WarningsDict, WarningsDict, Warnings]:
     # Get full list of logs from folder, excluding internal logs for filtering sake
-    internal_files: set[str] = {elem + '.log' for elem in ['failed', 'info', 'skipped', 'success']}
+    internal_files: set[str] = {elem + '.log' for elem in INTERNAL_LOGS}
     internal_files.add('report.txt')
-    logs: list[Path] = sorted(
-        [elem for elem in log_folder.iterdir() if elem.name not in internal_files]
-    )
-
-    # Generate a full list of warnings across all builds, deduplicated per build
-    searches: Warnings = [
-        'error:',
-        'Error:',
-        'ERROR:',
-        'FAILED:',
-        'FATAL:',
-        'undefined',
-        'Unsupported relocation type:',
-        'warning:',
-        'Warning:',
-        'WARNING:',
-    ]  # fmt: off
-    prob_re = re.compile('|'.join(searches))
-    warnings: WarningsDict = {}
-    for log in logs:
-        lines = log.read_text(encoding='utf-8').splitlines(keepends=True)
-        # We specifically check "dodgy linker" because this is known to be
-        # extremely noisy and will appear with most released versions of clang.
-        # They will still appear in the log files but they do not need to be
-        # logged in these reports.
-        warnings[log.name] = sorted(
-            {
-                line.replace(f"{src_folder}/", '')
-                for line in lines
-                if prob_re.search(line) and 'dodgy linker' not in line
-            }
-        )
-    full: WarningsDict = {key: value for key, value in warnings.items() if value}
-
-    # Filter warnings based on priority to fix
-    merge_config_ignore: Warnings = [
-        'CPU_BIG_ENDIAN',
-        'LTO_CLANG_THIN',
-        'PREEMPT',
-        'SQUASHFS_DECOMP_SINGLE',
-        'SQUASHFS_DECOMP_MULTI',
-        'SQUASHFS_DECOMP_MULTI_PERCPU',
-    ]
-    ignore: Warnings = [
-        # Too many to deal with for now
-        'objtool:',
-        '-Wframe-larger-than',
-        # Warnings from merge_config that are harmless
-        f"override: ({'|'.join(merge_config_ignore)}) changes choice state",
-        # https://github.com/ClangBuiltLinux/linux/issues/1065
-        r'union jset::\(anonymous at ./usr/include/linux/bcache.h:',
-        # https://github.com/ClangBuiltLinux/linux/issues/1427
-        "llvm-objdump: error: 'vmlinux': not a dynamic object",
-        # https://github.com/ClangBuiltLinux/linux/issues/1315
-        "unused during compilation: '-march=arm",
-        # https://github.com/ClangBuiltLinux/linux/issues/1555
-        r"scripts/(extract-cert|sign-file).c:[0-9]+:[0-9]+: warning: '(ENGINE|ERR)_.*' is deprecated \[-Wdeprecated-declarations\]",
-        # New binutils warnings that are not clang specific:
-        # https://sourceware.org/bugzilla/show_bug.cgi?id=29072
-        'missing .note.GNU-stack section implies executable stack',
-        r'requires executable stack \(because the .note.GNU-stack section is executable\)',
-        'has a LOAD segment with RWX permissions',
-        # https://github.com/llvm/llvm-project/issues/59037
-        'error: write on a pipe with no reader',
-        # https://github.com/ClangBuiltLinux/linux/issues/1415
-        '(asmmacro.h|genex.S|[0-9]+):.*macro defined with named parameters',
-        'macro local_irq_enable reg=',
-        # new warning present with make 4.4:
-        # https://lore.kernel.org/Y7i8+EjwdnhHtlrr@dev-arch.thelio-3990X/
-        'llvm-nm: error: arch/arm/boot/compressed/../../../../vmlinux: No such file or directory',
-        # Ignore all objdump warnings, most are from tool incompatibilities like DWARF5 handling
-        'gnu-objdump: Warning:',
-        # QEMU warnings, generally not useful
-        'qemu-system-[a-z0-9]+: warning:',
-        # QEMU warning for PowerPC on kernels prior to e4bb64c7a42e ("powerpc:
-        # remove interrupt handler functions from the noinstr section") in
-        # 5.12, backport is too hairy, just ignore.
-        r"WARNING: CPU: [0-9]+ PID: [0-9]+ at arch/powerpc/kernel/optprobes.c:[0-9]+ kretprobe_trampoline\+",
-        # Warning on boot when SRSO is not set, which is not really a problem
-        # for our simple QEMU boots.
-        'kernel not compiled with (CPU|MITIGATION)_SRSO',
-        # Warning when SRSO is missing some option, harmless for our quick and
-        # simple QEMU boots.
-        'See https://kernel.org/doc/html/latest/admin-guide/hw-vuln/srso.html for mitigation options.',
-        # Warning when CONFIG_NTFS3_64BIT_CLUSTER is enabled, which we do not
-        # care about at all.
-        'Activated 64 bits per cluster. Windows does not support this',
-        # Python 3.12 warnings, not ClangBuiltLinux related
-        'SyntaxWarning: invalid escape sequence',
-        # Warning from LoongArch firmware, who cares?
-        'Error: Image at [0-9A-F]+ start failed: Not Found',
-        # Harmless warning from LoongArch with newer version of QEMU and old version of defconfig
-        'Warning: Processor Platform Limit event detected, but not handled',
-        # New modpost warnings (may be upgraded to errors eventually)
-        'WARNING: modpost: missing MODULE_DESCRIPTION',
-        # Warning/error from rustc, hide because other errors/warnings will be shown
-        r"warning: \d+ warnings? emitted",
-        r"error: aborting due to \d+ previous errors",
-        # Known warning from rustc on s390
-        # https://lore.kernel.org/20260615164013.GA249489@ax162/
-        'warning: unstable feature specified for `-Ctarget-feature`: `backchain`',
-        # Known warnings from rustc on powerpc
-        # https://lore.kernel.org/20260804202217.GA1109939@ax162/
-        r"warning: (unknown and )?unstable feature specified for `-Ctarget-feature`: `(altivec|hard-float|mma|vsx)`",
-    ]
-    ignore_re = re.compile('|'.join(ignore))
-    warnings: WarningsDict = {}
-    for log, problems in full.items():
-        warnings[log] = sorted({item for item in problems if not ignore_re.search(item)})
-    filtered: WarningsDict = {key: value for key, value in warnings.items() if value}
+    # A log may exist both uncompressed and compressed, such as after an
+    # interrupted --compress, so only scan one copy of each log, preferring
+    # the uncompressed one like get_log() does.
+    logs_by_name: dict[str, Path] = {}
+    for elem in sorted(log_folder.iterdir(), key=get_log_preference):
+        if (name := get_log_name(elem)) not in internal_files:
+            logs_by_name.setdefault(name, elem)
+    logs: list[Path] = sorted(logs_by_name.values())
+
+    # Generate a full list of warnings across all builds, deduplicated per
+    # build, scanning the logs in parallel. map() returns results in the order
+    # of the logs, so the report is the same regardless of which log finished
+    # first.
+    full: WarningsDict = {}
+    filtered: WarningsDict = {}
+    if logs:
+        with ProcessPoolExecutor(max_workers=min(len(logs), os.cpu_count() or 1)) as executor:
+            for name, full_problems, filtered_problems in executor.map(
+                scan_log, logs, [src_folder] * len(logs), chunksize=4
+            ):
+                if full_problems:
+                    full[name] = full_problems
+                if filtered_problems:
+                    filtered[name] = filtered_problems
 
     # Deduplicate warnings across all builds
     unique: Warnings = sorted({item for problems in filtered.values() for item in problems})
@@ -178,14 +363,16 @@ def generate_git_log(src_folder: Path) -> str:
     return report_text
 
 
-def generate_report(log_folder: Path) -> str:
+def generate_report(
+    log_folder: Path, index_file: Path | None = None, new_only: bool = False
+) -> str:
     # First, we need to figure out the source directory, so we can eliminate
     # its path from all the warnings, which makes the report a little easier to
     # read.
     if not (info_log := get_log(log_folder, 'info')).exists():
         msg = 'info.log does not exist?'
         raise RuntimeError(msg)
-    info_text = info_log.read_text(encoding='utf-8')
+    info_text = read_log(info_log)
     if not (match := re.search(r'^Linux source location: (.*)$', info_text, flags=re.MULTILINE)):
         msg = 'Could not figure out source folder?'
         raise RuntimeError(msg)
@@ -201,16 +388,32 @@ def generate_report(log_folder: Path) -> str:
     #           list).
     full, filtered, unique = generate_warnings(log_folder, src_folder)
 
+    # Record the unique warnings from every run, whether or not new warnings
+    # are requested, so that a future run of the same tree can tell which of
+    # its warnings are new without any gaps in the history.
+    new: Warnings = []
+    if index_file:
+        index = WarningIndex(index_file)
+        try:
+            new = index.update(str(src_folder), log_folder.resolve().name, unique)
+        finally:
+            index.close()
+
     # Build report text based on log files and filtered warnings above.
     report_text = info_text
 
     if (failed_log := get_log(log_folder, 'failed')).exists():
         report_text += '\nList of failed tests:\n\n'
-        report_text += failed_log.read_text(encoding='utf-8')
+        report_text += read_log(failed_log)
 
     if (skipped_log := get_log(log_folder, 'skipped')).exists():
         report_text += '\nList of skipped tests:\n\n'
-        report_text += skipped_log.read_text(encoding='utf-8')
+        report_text += read_log(skipped_log)
+
+    if new_only and new:
+        report_text += '\nNew warning report:\n\n'
+        for warning in new:
+            report_text += warning
 
     if unique:
         report_text += '\nUnique warning report:\n\n'
@@ -225,7 +428,7 @@ def generate_report(log_folder: Path) -> str:
 
     if (success_log := get_log(log_folder, 'success')).exists():
         report_text += '\nList of successful tests:\n\n'
-        report_text += success_log.read_text(encoding='utf-8')
+        report_text += read_log(success_log)
 
     if full:
         report_text += '\nFull warning report:\n\n'
@@ -245,8 +448,11 @@ if __name__ == '__main__':
         msg = f"Logs folder ('{folder}') could not be found!"
         raise RuntimeError(msg)
 
-    report = generate_report(folder)
+    report = generate_report(folder, args.index_file, args.new_only)
     if args.print_to_stdout:
         print(report, end='')  # report_text has '\n' at the end already
     else:
         Path(folder, 'report.txt').write_text(report, encoding='utf-8')
+
+    if args.compress:
+        compress_logs(folder)
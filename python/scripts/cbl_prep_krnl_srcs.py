@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2026 Nathan Chancellor
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import lib.kernel
+
+VALID_TREES = (*lib.kernel.NEXT_TREES, 'linux-mainline-llvm')
+
+
+def parse_arguments():
+    parser = ArgumentParser(
+        description='Update and patch several kernel source trees at the same time'
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help=f"Number of trees to prepare at the same time (default: number of trees, up to {lib.kernel.SOURCE_PREP_JOBS})",
+        type=int,
+    )
+    parser.add_argument(
+        '-R', '--ref', default='origin/master', help='Reference to base kernel trees on'
+    )
+    # Not using 'choices', as argparse before Python 3.12 checks an empty
+    # list against them when no trees are passed
+    parser.add_argument(
+        'trees',
+        help=f"Trees to prepare, from {', '.join(VALID_TREES)} (default: all of them)",
+        metavar='TREE',
+        nargs='*',
+    )
+
+    args = parser.parse_args()
+    if invalid_trees := [tree for tree in args.trees if tree not in VALID_TREES]:
+        parser.error(f"invalid tree(s): {', '.join(invalid_trees)}")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    lib.kernel.prepare_sources(args.trees or list(VALID_TREES), args.ref, args.jobs)
@@ -429,30 +429,73 @@ def create_monthly_report_file(report_file: Path, report_date: datetime.datetime
     report_file.write_text(template, encoding='utf-8')
 
 
+# Tags to classify commits in the yearly report by, keyed by bucket name
+YEARLY_TRAILERS = {
+    'reported': 'Reported-by',
+    'reviewed': 'Reviewed-by',
+    'tested': 'Tested-by',
+}
+YearlyCommits = dict[str, dict[str, str]]
+
+
 def get_yearly_commits(
     year: int,
     source: Path,
     branch: str = 'main',
-    git_log_args: lib.utils.CmdList | None = None,
     update: bool = True,
-) -> dict[str, str]:
+) -> YearlyCommits:
     if update:
         lib.utils.call_git(source, ['remote', 'update', '--prune', 'origin'])
+
+    # A year of history does not change unless the branch does, so cache the
+    # classified commits based on where the branch is.
+    head = lib.utils.get_git_output(source, ['rev-parse', f"origin/{branch}"])
+    cache_file = Path(
+        os.environ.get('XDG_CACHE_FOLDER', Path.home().joinpath('.cache')),
+        'cbl_report',
+        f"{source.name}-{year}-{head}.json",
+    )
+    if cache_file.exists():
+        return json.loads(cache_file.read_text(encoding='utf-8'))
+
+    # Walk the year once with the author and message of each commit, rather
+    # than once for each of the lists below with --author or --grep, and
+    # classify each commit into all of the lists that it belongs in, which
+    # keeps them in the same order as git log. Tags are searched for anywhere
+    # in the message, like '--grep' does, rather than only in the trailers,
+    # so that the lists match the git log commands in the report.
     git_log_cmd: lib.utils.CmdList = [
         'log',
-        '--format=%H %s',
+        '-z',
+        '--format=%H%x1f%an <%ae>%x1f%s%x1f%B',
         '--no-merges',
         f"--since-as-filter=Jan 1, {year}",
         f"--until=Jan 1, {year + 1}",
-        f"origin/{branch}",
+        head,
     ]
-    if git_log_args:
-        git_log_cmd += git_log_args
-    else:
-        git_log_cmd.append('--author=Nathan Chancellor')
     git_log_output = lib.utils.call_git(source, git_log_cmd)
 
-    return dict(item.split(' ', 1) for item in git_log_output.stdout.splitlines())
+    commits: YearlyCommits = {
+        bucket: {} for bucket in ('authored', *YEARLY_TRAILERS, 'reported_reviewed_tested')
+    }
+    for item in git_log_output.stdout.split('\0'):
+        if not item:
+            continue
+        sha, author, title, message = item.split('\x1f', 3)
+        if 'Nathan Chancellor' in author:
+            commits['authored'][sha] = title
+        for bucket, trailer in YEARLY_TRAILERS.items():
+            if f"{trailer}: Nathan Chancellor" in message:
+                commits[bucket][sha] = title
+                commits['reported_reviewed_tested'][sha] = title
+
+    # Only the cache for the current position of the branch is useful
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    for old_cache_file in cache_file.parent.glob(f"{source.name}-{year}-*.json"):
+        old_cache_file.unlink(missing_ok=True)
+    cache_file.write_text(json.dumps(commits, indent=4), encoding='utf-8')
+
+    return commits
 
 
 def generate_html_commit_section(commits, repo):
@@ -501,42 +544,33 @@ def create_yearly_report_file(report_file, report_date, year: int) -> None:
     }
 
     linux_src = Path(os.environ['CBL_SRC'], 'linux-next')
-    linux_gyc_kwargs: dict[str, Any] = {
-        'year': year,
-        'source': linux_src,
-        'branch': 'master',
-    }
-    linux_commits = get_yearly_commits(**linux_gyc_kwargs)
+    linux_yearly_commits = get_yearly_commits(year, linux_src, branch='master')
+    linux_commits = linux_yearly_commits['authored']
     linux_commit_links = generate_html_commit_section(linux_commits, linux_link)
-    # Updating the Linux repo is no longer necessary after the initial update
-    linux_gyc_kwargs['update'] = False
-    # We could generate linux_rep_rev_tst from the combination of the other
-    # three but then the commits will not be in order as they would be from git
-    # log, so just generate a fourth dictionary *shrugs*
-    linux_rep_rev_tst = get_yearly_commits(**linux_gyc_kwargs, git_log_args=['--extended-regexp', '--grep=(Report|Review|Test)ed-by: Nathan Chancellor'])
+    linux_rep_rev_tst = linux_yearly_commits['reported_reviewed_tested']
     linux_rep_rev_tst_links = generate_html_commit_section(linux_rep_rev_tst, linux_link)
-    linux_rep = get_yearly_commits(**linux_gyc_kwargs, git_log_args=['--grep=Reported-by: Nathan Chancellor'])
-    linux_rev = get_yearly_commits(**linux_gyc_kwargs, git_log_args=['--grep=Reviewed-by: Nathan Chancellor'])
-    linux_tst = get_yearly_commits(**linux_gyc_kwargs, git_log_args=['--grep=Tested-by: Nathan Chancellor'])
+    linux_rep = linux_yearly_commits['reported']
+    linux_rev = linux_yearly_commits['reviewed']
+    linux_tst = linux_yearly_commits['tested']
 
     llvm_src = Path(os.environ['CBL_SRC'], 'llvm-project')
-    llvm_commits = get_yearly_commits(year, llvm_src)
+    llvm_commits = get_yearly_commits(year, llvm_src)['authored']
     llvm_links = generate_html_commit_section(llvm_commits, llvm_link)
 
     boot_utils_src = Path(os.environ['CBL_GIT'], 'boot-utils')
-    boot_utils_commits = get_yearly_commits(year, boot_utils_src)
+    boot_utils_commits = get_yearly_commits(year, boot_utils_src)['authored']
     boot_utils_links = generate_html_commit_section(boot_utils_commits, boot_utils_link)
 
     ci_src = Path(os.environ['CBL_GIT'], 'continuous-integration2')
-    ci_commits = get_yearly_commits(year, ci_src)
+    ci_commits = get_yearly_commits(year, ci_src)['authored']
     ci_links = generate_html_commit_section(ci_commits, ci_link)
 
     tc_build_src = Path(os.environ['CBL_GIT'], 'tc-build')
-    tc_build_commits = get_yearly_commits(year, tc_build_src)
+    tc_build_commits = get_yearly_commits(year, tc_build_src)['authored']
     tc_build_links = generate_html_commit_section(tc_build_commits, tc_build_link)
 
     tuxmake_src = Path(os.environ['CBL_SRC'], 'tuxmake')
-    tuxmake_commits = get_yearly_commits(year, tuxmake_src, branch='master')
+    tuxmake_commits = get_yearly_commits(year, tuxmake_src, branch='master')['authored']
     tuxmake_links = generate_html_commit_section(tuxmake_commits, tuxmake_link)
 
     report_links = [f"- [{month} {year}](/posts/{month.lower()}-{year}-cbl-work/)" for month in calendar.month_name if month]
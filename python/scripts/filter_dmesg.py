@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
+import json
+import multiprocessing
+import os
 import re
 import socket
 import sys
+import time
+from argparse import SUPPRESS, ArgumentParser
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import lib.utils
 
-lib.utils.handle_help_arg('Filter dmesg for known warnings')
-
 BT_LE_CODED_PHY = (
     r"Bluetooth: hci0: HCI LE Coded PHY feature bit is set, but its usage is not supported\."
 )
@@ -183,9 +190,358 @@ ALLOWLIST = {
 }
 ANSI_STRIP = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
 
+# Parts of a message that vary between hosts and boots, which are stripped to
+# group the same message from multiple hosts together
+NORMALIZE_SUBS = [
+    # Timestamp
+    (re.compile(r'^\[\s*\d+\.\d+\]\s*'), ''),
+    # Addresses and offsets
+    (re.compile(r'0x[0-9a-fA-F]+'), '0x?'),
+    # CPU numbers, PIDs, line numbers, etc
+    (re.compile(r'\b\d+\b'), 'N'),
+]
+
+KMSG = Path('/dev/kmsg')
+# Matches '--level=warn+' of dmesg
+KMSG_MAX_LEVEL = 4  # KERN_WARNING
+# Each read() of /dev/kmsg returns exactly one record, which is never larger
+# than this in the kernel (CONSOLE_EXT_LOG_MAX)
+KMSG_RECORD_SIZE = 8192
+# Escapes of a single letter in a regex that are not literal characters
+SINGLE_ESCAPES = 'AbBdDsSwWZafnrtv'
+
+
+def get_literal(regex: str) -> str:
+    # Find the longest run of literal characters that every match of regex
+    # must contain. Anything that is not obviously a literal ends the current
+    # run, which may miss a longer literal but never returns one that a match
+    # could lack.
+    literals: list[str] = []
+    current = ''
+    idx = 0
+    while idx < len(regex):
+        char = regex[idx]
+        # Alternation at the top level means no single literal is required
+        if char == '|':
+            return ''
+        # The character before a quantifier may not be present at all
+        if char in '*+?{':
+            literals.append(current[:-1])
+            current = ''
+            if char == '{' and (end := regex.find('}', idx)) != -1:
+                idx = end
+        elif char in '([':
+            literals.append(current)
+            current = ''
+            idx = skip_group(regex, idx) if char == '(' else skip_class(regex, idx)
+        elif char == '\\':
+            idx += 1
+            # Escapes of a single letter, such as '\d' and '\s', and back
+            # references of a single digit do not match a known literal
+            if regex[idx] in SINGLE_ESCAPES or (
+                regex[idx] in '123456789' and not regex[idx + 1 : idx + 2].isdigit()
+            ):
+                literals.append(current)
+                current = ''
+            # Other escapes of letters and digits, such as '\x41', '\u0041',
+            # '\N{...}', or octal escapes, span more than one character, so
+            # do not try to find a literal in this regex at all.
+            elif regex[idx].isalnum():
+                return ''
+            else:
+                current += regex[idx]
+        elif char in '.^$':
+            literals.append(current)
+            current = ''
+        else:
+            current += char
+        idx += 1
+    literals.append(current)
+    return max(literals, key=len)
+
+
+def skip_class(regex: str, idx: int) -> int:
+    # Return the index of the ']' that closes the character class at idx
+    idx += 1
+    # A ']' at the start of the class is a literal ']'
+    if regex.startswith('^', idx):
+        idx += 1
+    if regex.startswith(']', idx):
+        idx += 1
+    while idx < len(regex) and regex[idx] != ']':
+        if regex[idx] == '\\':
+            idx += 1
+        idx += 1
+    return idx
+
+
+def skip_group(regex: str, idx: int) -> int:
+    # Return the index of the ')' that closes the group at idx
+    depth = 0
+    while idx < len(regex):
+        char = regex[idx]
+        if char == '\\':
+            idx += 1
+        elif char == '[':
+            idx = skip_class(regex, idx)
+        elif char == '(':
+            depth += 1
+        elif char == ')' and (depth := depth - 1) == 0:
+            return idx
+        idx += 1
+    return idx
+
+
+class AllowlistMatcher:
+    def __init__(self, allowlist: Iterable[str]) -> None:
+        # Hosts may share lists of warnings with 'common', only check them once
+        self.allowlist: list[str] = list(dict.fromkeys(allowlist))
+        self.hits: dict[str, int] = dict.fromkeys(self.allowlist, 0)
+
+        # Compile each entry once up front and pair it with a literal that
+        # must be in a line for the entry to match, which is much cheaper to
+        # check for than running the regular expression.
+        self.entries: list[tuple[str, str, re.Pattern[str]]] = [
+            (entry, get_literal(entry), re.compile(entry)) for entry in self.allowlist
+        ]
+
+    def match(self, line: str) -> str | None:
+        for entry, literal, regex in self.entries:
+            if literal in line and regex.search(line):
+                self.hits[entry] += 1
+                return entry
+        return None
+
+    def filter(self, lines: Iterable[str]) -> Iterator[tuple[str, str | None]]:
+        for line in lines:
+            yield line, self.match(ANSI_STRIP.sub('', line))
+
+    def get_stale(self) -> list[str]:
+        return [entry for entry, hits in self.hits.items() if not hits]
+
+
+@cache
+def get_matcher(hostname: str) -> AllowlistMatcher:
+    return AllowlistMatcher(ALLOWLIST['common'] + ALLOWLIST.get(hostname, []))
+
+
+def normalize(line: str) -> str:
+    line = ANSI_STRIP.sub('', line)
+    for regex, replacement in NORMALIZE_SUBS:
+        line = regex.sub(replacement, line)
+    return line.strip()
+
+
+def filter_dmesg_file(dmesg_file: Path) -> tuple[str, Counter[str]]:
+    hostname = dmesg_file.name.removesuffix('.dmesg')
+    with dmesg_file.open(encoding='utf-8', errors='replace') as file:
+        unexpected = Counter(
+            normalize(line) for line, entry in get_matcher(hostname).filter(file) if not entry
+        )
+    return hostname, unexpected
+
+
+def triage_fleet(folder: Path, jobs: int | None) -> None:
+    if not (dmesg_files := sorted(folder.glob('*.dmesg'))):
+        msg = f"No .dmesg files found in {folder}!"
+        raise FileNotFoundError(msg)
+
+    hostnames = [dmesg_file.name.removesuffix('.dmesg') for dmesg_file in dmesg_files]
+    for hostname in hostnames:
+        if hostname not in ALLOWLIST:
+            lib.utils.print_yellow(
+                f"WARNING: {hostname} not in ALLOWLIST, only using common allowlist entries..."
+            )
+        # Compile each allowlist before starting the workers so that they
+        # inherit them, rather than every worker compiling them again.
+        get_matcher(hostname)
+
+    # Workers only inherit the compiled allowlists when they are forked,
+    # which is not the default start method on all Python versions.
+    messages: defaultdict[str, Counter[str]] = defaultdict(Counter)
+    with ProcessPoolExecutor(
+        max_workers=jobs or min(len(dmesg_files), os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context('fork'),
+    ) as executor:
+        for hostname, unexpected in executor.map(filter_dmesg_file, dmesg_files):
+            for message, count in unexpected.items():
+                messages[message][hostname] += count
+
+    if not messages:
+        lib.utils.print_green(f"No unexpected messages from {len(dmesg_files)} hosts")
+        return
+
+    lib.utils.print_header(f"{len(messages)} unexpected messages from {len(dmesg_files)} hosts")
+    # Show the messages that occur on the most hosts first, as those are
+    # more likely to be a problem with the kernel than the machine.
+    for message, hosts in sorted(
+        messages.items(), key=lambda item: (-len(item[1]), -item[1].total(), item[0])
+    ):
+        print(message)
+        host_counts = ', '.join(f"{host} ({count})" for host, count in sorted(hosts.items()))
+        print(f"    {hosts.total()} times on {len(hosts)} hosts: {host_counts}\n")
+
+
+class KmsgCursor:
+    # Saving the cursor for every record would write and rename the cursor
+    # file for each message during a flood, so save it after this many records
+    # or seconds, whichever comes first, and when done reading.
+    SAVE_RECORDS = 100
+    SAVE_INTERVAL = 5
+
+    def __init__(self, cursor_file: Path, owner: tuple[int, int] | None = None) -> None:
+        self.cursor_file: Path = cursor_file
+        # The user and group that should own the cursor when running as root
+        # on behalf of a regular user, so that it can be used by that user
+        # later.
+        self.owner: tuple[int, int] | None = owner
+
+        # Sequence numbers start over on each boot
+        self.boot_id: str = (
+            Path('/proc/sys/kernel/random/boot_id').read_text(encoding='utf-8').strip()
+        )
+        cursor = json.loads(cursor_file.read_text(encoding='utf-8')) if cursor_file.exists() else {}
+        self.seq: int = cursor['seq'] if cursor.get('boot_id') == self.boot_id else -1
+
+        self.saved_time: float = time.monotonic()
+        self.unsaved: int = 0
+
+    def save_periodically(self) -> None:
+        self.unsaved += 1
+        if (
+            self.unsaved >= self.SAVE_RECORDS
+            or time.monotonic() - self.saved_time >= self.SAVE_INTERVAL
+        ):
+            self.save()
+
+    def save(self) -> None:
+        if not (parent := self.cursor_file.parent).exists():
+            created = [folder for folder in (parent, *parent.parents) if not folder.exists()]
+            parent.mkdir(parents=True)
+            if self.owner:
+                for folder in created:
+                    os.chown(folder, *self.owner)
+        (tmp_file := self.cursor_file.with_name(f"{self.cursor_file.name}.tmp")).write_text(
+            json.dumps({'boot_id': self.boot_id, 'seq': self.seq}), encoding='utf-8'
+        )
+        if self.owner:
+            os.chown(tmp_file, *self.owner)
+        tmp_file.replace(self.cursor_file)
+
+        self.saved_time = time.monotonic()
+        self.unsaved = 0
+
+
+def parse_kmsg_record(record: str) -> tuple[int, int, str]:
+    # '<facility and level>,<seq>,<usecs>,<flags>[,...];<message>\n', which may
+    # be followed by ' KEY=value' lines that are not part of the message
+    prefix, message = record.split(';', 1)
+    prio, seq, usecs = prefix.split(',', 3)[:3]
+    message = message.split('\n', 1)[0]
+    return int(prio) & 7, int(seq), f"[{int(usecs) / 1000000:12.6f}] {message}"
+
+
+def open_kmsg(follow: bool) -> int:
+    # Reads block until there is a new record when following
+    return os.open(KMSG, os.O_RDONLY if follow else os.O_RDONLY | os.O_NONBLOCK)
+
+
+def read_kmsg(kmsg_fd: int, cursor: KmsgCursor) -> Iterator[str]:
+    # Read records one at a time so that memory usage does not depend on the
+    # size of the ring buffer or how long the kernel has been running.
+    try:
+        while True:
+            try:
+                record = os.read(kmsg_fd, KMSG_RECORD_SIZE).decode('utf-8', errors='replace')
+            # There are no more records and we are not following
+            except BlockingIOError:
+                break
+            # Records were overwritten before they could be read, the next read
+            # will return the oldest record still available.
+            except BrokenPipeError:
+                continue
+
+            level, seq, line = parse_kmsg_record(record)
+            # Already processed by a previous invocation
+            if seq <= cursor.seq:
+                continue
+            cursor.seq = seq
+            if level <= KMSG_MAX_LEVEL:
+                # Only lines at this level can be shown so the cursor only
+                # needs to be saved here to avoid showing them again.
+                cursor.save_periodically()
+                yield line
+    finally:
+        os.close(kmsg_fd)
+        cursor.save()
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Filter dmesg for known warnings')
+
+    parser.add_argument(
+        '-b',
+        '--batch',
+        help='Filter a folder of <hostname>.dmesg files and show a combined report',
+        type=Path,
+    )
+    parser.add_argument(
+        '-c',
+        '--cursor-file',
+        default=Path(
+            os.environ.get('XDG_CACHE_FOLDER', Path.home().joinpath('.cache')),
+            'filter_dmesg/kmsg_cursor.json',
+        ),
+        help='File to store the last message processed from /dev/kmsg in (default: %(default)s)',
+        type=Path,
+    )
+    # Passed when running again as root to keep the cursor owned by the user
+    parser.add_argument('--cursor-owner', help=SUPPRESS)
+    parser.add_argument(
+        '-f',
+        '--follow',
+        action='store_true',
+        help='Filter new messages from /dev/kmsg as they arrive, starting after the saved cursor',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of files to filter in parallel with --batch (default: number of CPUs)',
+        type=int,
+    )
+    parser.add_argument(
+        '-m',
+        '--show-matches',
+        action='store_true',
+        help='Show filtered lines with the allowlist entry that matched them',
+    )
+    parser.add_argument(
+        '-n',
+        '--new',
+        action='store_true',
+        help='Filter messages from /dev/kmsg after the saved cursor then exit',
+    )
+    parser.add_argument(
+        '-s',
+        '--show-stale',
+        action='store_true',
+        help='Show allowlist entries that did not match any line',
+    )
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.batch:
+        triage_fleet(args.batch, args.jobs)
+        sys.exit(0)
+
+    use_kmsg = args.follow or args.new
+
     dmesg_txt = None
-    if not sys.stdin.isatty():
+    if not use_kmsg and not sys.stdin.isatty():
         dmesg_txt = sys.stdin.read()
 
     if (hostname := socket.gethostname()) not in ALLOWLIST:
@@ -194,17 +550,51 @@ if __name__ == '__main__':
             print(dmesg_txt, end='')
         sys.exit(0)
 
-    if not dmesg_txt:
-        lib.utils.request_root('accessing dmesg')
-        dmesg_cmd = ['dmesg', '--color=always', '--level=warn+']
-        dmesg_txt = lib.utils.run0(dmesg_cmd, capture_output=True).stdout
+    if use_kmsg:
+        # /dev/kmsg is only readable by root when dmesg_restrict is enabled,
+        # which the permissions of /dev/kmsg do not reflect, so try to open it
+        # then run again as root but keep using this user's cursor.
+        try:
+            kmsg_fd = open_kmsg(args.follow)
+        except PermissionError:
+            if os.geteuid() == 0:
+                raise
+            lib.utils.request_root('accessing /dev/kmsg')
+            cmd = [
+                sys.executable,
+                __file__,
+                *sys.argv[1:],
+                '--cursor-file',
+                args.cursor_file,
+                '--cursor-owner',
+                f"{os.getuid()}:{os.getgid()}",
+            ]
+            sys.exit(lib.utils.run0(cmd, check=False).returncode)
+        owner = None
+        if args.cursor_owner:
+            uid, gid = args.cursor_owner.split(':')
+            owner = (int(uid), int(gid))
+        dmesg_lines = read_kmsg(kmsg_fd, KmsgCursor(args.cursor_file, owner))
+    else:
+        if not dmesg_txt:
+            lib.utils.request_root('accessing dmesg')
+            dmesg_cmd = ['dmesg', '--color=always', '--level=warn+']
+            dmesg_txt = lib.utils.run0(dmesg_cmd, capture_output=True).stdout
+        dmesg_lines = dmesg_txt.splitlines()
 
-    allowlist = ALLOWLIST['common'] + ALLOWLIST[hostname]
+    matcher = get_matcher(hostname)
 
-    for dmesg_line in dmesg_txt.splitlines():
-        escaped_line = ANSI_STRIP.sub('', dmesg_line)
-        for regex in allowlist:
-            if re.search(regex, escaped_line):
-                break
-        else:
-            print(dmesg_line)
+    try:
+        for dmesg_line, entry in matcher.filter(dmesg_lines):
+            if not entry:
+                print(dmesg_line, flush=use_kmsg)
+            elif args.show_matches:
+                lib.utils.print_yellow(f"ALLOWED: {ANSI_STRIP.sub('', dmesg_line)}\n    ({entry})")
+    except KeyboardInterrupt:
+        if not args.follow:
+            raise
+
+    if args.show_stale and (stale := matcher.get_stale()):
+        lib.utils.print_yellow(f"\nAllowlist entries that did not match for {hostname}:\n")
+        for entry in stale:
+            print(entry)
@@ -40,7 +40,21 @@ def parse_arguments():
         action='append',
         help='Prepend specified directory to PATH (can be specified multiple times)',
     )
-    parser.add_argument('-j', '--jobs', default=os.cpu_count(), help='Number of jobs', type=int)
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of jobs (default: based on available CPUs and memory, with KMAKE_JOB_MEM_MB as the memory of each compile job in MiB)',
+        type=int,
+    )
+    parser.add_argument(
+        '-l',
+        '--load-limit',
+        action='store_true',
+        help='Do not start new jobs when the load average is above the number of CPUs of the host, as the load average is for the whole host even in containers',
+    )
+    parser.add_argument(
+        '--log-file', help='Save the output of make to this file as well', type=Path
+    )
     parser.add_argument('--use-time', action='store_true', help="Call 'time -v' for time tracking")
     parser.add_argument('-v', '--verbose', action='store_true', help='Do a more verbose build')
     parser.add_argument('make_args', help='Make variables and targets', nargs='*')
@@ -115,6 +129,8 @@ if __name__ == '__main__':
         ccache=(not args.no_ccache),
         directory=args.directory,
         jobs=args.jobs,
+        load_average=os.cpu_count() if args.load_limit else None,
+        log_file=args.log_file,
         silent=(not args.verbose),
         use_time=args.use_time,
     )
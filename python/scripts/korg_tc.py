@@ -11,14 +11,20 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2024 Nathan Chancellor
 
+import json
 import os
 import platform
 import shlex
 import shutil
+import subprocess
 import sys
+import threading
+import time
 from argparse import ArgumentParser, BooleanOptionalAction
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import Any
 
 import requests
@@ -56,6 +62,8 @@ LATEST_LLVM_VERSIONS: dict[int, str] = {
     12: '12.0.1',
     11: '11.1.0',
 }
+# 1MB at a time
+DOWNLOAD_CHUNK_SIZE = 1048576
 
 
 # set() does not preserve order
@@ -67,6 +75,14 @@ def generate_versions(min_var: str, tot_var: str) -> list[int]:
     return list(range(int(os.environ[min_var]), int(os.environ[tot_var])))
 
 
+def format_size(num_bytes: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GiB"
+
+
 def handle_rc_version(version: str) -> tuple[int, ...]:
     major, minor, patch = version.split('.')
     if '-' in patch:  # -rc version
@@ -81,17 +97,253 @@ def shell_quote(item: lib.utils.PathString) -> str:
     return shlex.quote(str(item))
 
 
+class TarballCache:
+    INDEX_NAME = '.korg_tc_index.json'
+
+    def __init__(self, folder: Path) -> None:
+        self.folder: Path = folder
+        self.index: Path = Path(folder, self.INDEX_NAME)
+        # Tarballs are handled in parallel so guard the entries and the writes
+        # of the index file.
+        self.lock: threading.Lock = threading.Lock()
+
+        self.entries: dict[str, dict[str, Any]] = (
+            json.loads(self.index.read_text(encoding='utf-8')) if self.index.exists() else {}
+        )
+
+    def get_key(self, tarball: Path) -> str:
+        return tarball.relative_to(self.folder).as_posix()
+
+    def evict(self, major_version: int, latest_version: tuple[int, ...]) -> None:
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                found_version = handle_rc_version(entry['version'])
+                if found_version[0] == major_version and found_version < latest_version:
+                    lib.utils.print_green(f"INFO: Removing {key}...")
+                    (tarball := Path(self.folder, key)).unlink(missing_ok=True)
+                    del self.entries[key]
+                    # Clean up the version folder once it is empty, unless it
+                    # has already been removed
+                    if (
+                        tarball.parent != self.folder
+                        and tarball.parent.exists()
+                        and not any(tarball.parent.iterdir())
+                    ):
+                        tarball.parent.rmdir()
+            self.save()
+
+    def forget(self, tarball: Path) -> None:
+        with self.lock:
+            if self.entries.pop(self.get_key(tarball), None):
+                self.save()
+
+    def is_verified(self, tarball: Path, expected_sha256: str | None) -> bool:
+        with self.lock:
+            if not (entry := self.entries.get(self.get_key(tarball))):
+                return False
+        # If the size or modification time changed since the tarball was
+        # validated, it was either modified or only partially written. If the
+        # published checksum changed, the tarball was replaced upstream.
+        tarball_stat = tarball.stat()
+        return (
+            entry['size'] == tarball_stat.st_size
+            and entry['mtime'] == tarball_stat.st_mtime_ns
+            and entry['sha256'] == expected_sha256
+        )
+
+    def record(self, tarball: Path, sha256: str, version: str) -> None:
+        tarball_stat = tarball.stat()
+        with self.lock:
+            self.entries[self.get_key(tarball)] = {
+                'mtime': tarball_stat.st_mtime_ns,
+                'sha256': sha256,
+                'size': tarball_stat.st_size,
+                'version': version,
+            }
+            self.save()
+
+    # Must be called with self.lock held
+    def save(self) -> None:
+        # Write to a temporary file then rename it so that an interrupted write
+        # cannot corrupt the index.
+        tmp_index = self.index.with_name(f"{self.index.name}.tmp")
+        tmp_index.write_text(json.dumps(self.entries, indent=4, sort_keys=True), encoding='utf-8')
+        tmp_index.replace(self.index)
+
+
 class Tarball:
     def __init__(self):
         self.base_download_url: str = ''
+        self.cache: TarballCache | None = None
         self.extraction_location: Path | None = None
         self.extracted_file: Path | None = None
         self.local_location: Path | None = None
         self.remote_tarball_name: str = ''
         self.remote_checksum_name: str = ''
         self.strip_components: int = 1
+        self.version: str = ''
+
+    def download(self, local_tarball: Path) -> int:
+        # Download to a temporary '.part' file so that an interrupted download
+        # can be resumed with a Range request on the next run and a partial
+        # tarball is never mistaken for a complete one.
+        partial_tarball = local_tarball.with_name(f"{local_tarball.name}.part")
+        partial_tarball.parent.mkdir(exist_ok=True, parents=True)
+
+        headers: dict[str, str] = {}
+        if offset := partial_tarball.stat().st_size if partial_tarball.exists() else 0:
+            lib.utils.print_green(
+                f"INFO: Resuming download of {local_tarball.name} from {format_size(offset)}..."
+            )
+            headers['Range'] = f"bytes={offset}-"
+        else:
+            lib.utils.print_green(f"INFO: Downloading {local_tarball.name}...")
+
+        downloaded = 0
+        url = f"{self.base_download_url}/{local_tarball.name}"
+        with requests.get(url, headers=headers, stream=True, timeout=3600) as response:
+            # The partial file is already as big as the remote file, which the
+            # checksum validation will sort out if it is not correct.
+            if offset and response.status_code == requests.codes.range_not_satisfiable:
+                partial_tarball.replace(local_tarball)
+                return downloaded
+            response.raise_for_status()
+
+            # The server may not honor the Range request, start over if so
+            mode = 'ab' if response.status_code == requests.codes.partial_content else 'wb'
+            with partial_tarball.open(mode) as file:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    downloaded += len(chunk)
+
+        partial_tarball.replace(local_tarball)
+
+        return downloaded
+
+    def get_expected_sha256(self) -> str | None:
+        # The manifest is cached, so this does not download it again when it
+        # has not changed.
+        return lib.sha256.get_from_url(
+            f"{self.base_download_url}/{self.remote_checksum_name}",
+            self.remote_tarball_name,
+        )
+
+    def validate(self, local_tarball: Path) -> None:
+        try:
+            sha256 = lib.sha256.validate_from_url(
+                local_tarball,
+                f"{self.base_download_url}/{self.remote_checksum_name}",
+            )
+        except RuntimeError:
+            # Do not let a bad tarball be picked up by a future run
+            local_tarball.unlink()
+            if self.cache:
+                self.cache.forget(local_tarball)
+            raise
+
+        if self.cache:
+            self.cache.record(local_tarball, sha256, self.version)
+
+    def get_tar_cmd(
+        self, tarball: Path | str, comp_ext: str, destination: Path
+    ) -> lib.utils.CmdList:
+        tar_cmd: lib.utils.CmdList = [
+            'tar',
+            '-C', destination,
+            f"--strip-components={self.strip_components}",
+            '-x',
+            '-f', tarball,
+        ]  # fmt: off
+
+        if comp_ext == '.xz':
+            tar_cmd.append('-J')
+        elif comp_ext == '.zst':
+            tar_cmd.append('--zstd')
+        elif comp_ext != '.tar':
+            msg = f"Compression extension ('{comp_ext}') not supported!"
+            raise RuntimeError(msg)
+
+        return tar_cmd
+
+    def staging_folder(self) -> TemporaryDirectory:
+        if not self.extraction_location:
+            msg = 'No extraction location configured for tarball?'
+            raise RuntimeError(msg)
+        # Several tarballs may be extracted into the same location at the same
+        # time (such as the GCC tarballs for each target of one version), so
+        # extract each one into its own folder on the same file system first.
+        self.extraction_location.parent.mkdir(exist_ok=True, parents=True)
+        return TemporaryDirectory(
+            dir=self.extraction_location.parent, prefix=f".{self.extraction_location.name}-"
+        )
+
+    def move_into_place(self, staging: Path) -> None:
+        if not self.extraction_location or not self.extracted_file:
+            msg = 'Attempting to call move_into_place() without an extraction location?'
+            raise RuntimeError(msg)
+
+        # Rename each file into the extraction location, with the extracted
+        # file last so that it only exists once everything else does.
+        extracted_file = self.extracted_file.relative_to(self.extraction_location)
+        for root, folders, files in os.walk(staging):
+            destination = Path(self.extraction_location, Path(root).relative_to(staging))
+            # Other tarballs extracted into the same location, possibly at the
+            # same time, may have left something else where this one has a
+            # folder or a file. rename() can only replace a folder with an
+            # empty one, so remove anything that is in the way.
+            if destination.is_symlink() or (destination.exists() and not destination.is_dir()):
+                destination.unlink(missing_ok=True)
+            destination.mkdir(exist_ok=True, parents=True)
+            # os.walk() lists symlinks to folders as folders but does not
+            # descend into them, so move them like files.
+            for name in [*files, *(item for item in folders if Path(root, item).is_symlink())]:
+                if (source := Path(root, name)).relative_to(staging) == extracted_file:
+                    continue
+                if (target := Path(destination, name)).is_dir() and not target.is_symlink():
+                    shutil.rmtree(target, ignore_errors=True)
+                source.replace(target)
+        Path(staging, extracted_file).replace(self.extracted_file)
+
+    def stream_extract(self, local_tarball: Path) -> int:
+        if not self.extraction_location or not self.extracted_file:
+            msg = 'Attempting to call stream_extract() without an extraction location?'
+            raise RuntimeError(msg)
 
-    def handle(self) -> None:
+        lib.utils.print_green(f"INFO: Downloading and extracting {local_tarball.name}...")
+
+        downloaded = 0
+        url = f"{self.base_download_url}/{local_tarball.name}"
+        # A partially extracted toolchain is left behind in the staging
+        # folder, so it is never mistaken for a complete one by a future run.
+        with self.staging_folder() as staging:
+            # Feed the response to tar as it arrives so that decompression
+            # happens while the download is still in progress and the tarball
+            # is never held in memory as a whole.
+            tar_cmd = self.get_tar_cmd('-', local_tarball.suffix, Path(staging))
+            lib.utils.print_cmd(tar_cmd)
+
+            with requests.get(url, stream=True, timeout=3600) as response:
+                response.raise_for_status()
+
+                with subprocess.Popen(tar_cmd, bufsize=0, stdin=subprocess.PIPE) as tar_proc:
+                    try:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            tar_proc.stdin.write(chunk)  # ty: ignore[possibly-missing-attribute]
+                            downloaded += len(chunk)
+                    except BrokenPipeError:
+                        pass  # tar exited early, its return code will explain why
+                    except:
+                        tar_proc.kill()
+                        raise
+
+            if tar_proc.returncode != 0:
+                raise subprocess.CalledProcessError(tar_proc.returncode, tar_cmd)
+
+            self.move_into_place(Path(staging))
+
+        return downloaded
+
+    def handle(self) -> int:
         if not self.extracted_file:
             msg = 'No extracted file to test for tarball?'
             raise RuntimeError(msg)
@@ -101,51 +353,45 @@ class Tarball:
 
         if self.extracted_file.exists() and not self.remote_checksum_name:
             lib.utils.print_green(f"SKIP: Content of {self.remote_tarball_name} exists locally...")
-            return
+            return 0
 
+        downloaded = 0
         local_tarball = Path(self.local_location, self.remote_tarball_name)
+        if (
+            local_tarball.exists()
+            and self.cache
+            and not self.cache.is_verified(local_tarball, self.get_expected_sha256())
+        ):
+            lib.utils.print_yellow(
+                f"WARNING: {local_tarball.name} has not been verified or has changed, validating..."
+            )
+            try:
+                self.validate(local_tarball)
+            except RuntimeError as err:
+                lib.utils.print_yellow(f"WARNING: {err} Downloading it again...")
         if not local_tarball.exists():
-            lib.utils.print_green(f"INFO: Downloading {local_tarball.name}...")
-
-            response = requests.get(f"{self.base_download_url}/{local_tarball.name}", timeout=3600)
-            response.raise_for_status()
+            if not self.remote_checksum_name:
+                return self.stream_extract(local_tarball)
 
-            if self.remote_checksum_name:
-                local_tarball.parent.mkdir(exist_ok=True, parents=True)
-                local_tarball.write_bytes(response.content)
-                lib.sha256.validate_from_url(
-                    local_tarball,
-                    f"{self.base_download_url}/{self.remote_checksum_name}",
-                )
+            downloaded = self.download(local_tarball)
+            self.validate(local_tarball)
 
         if self.extraction_location and not self.extracted_file.exists():
-            self.extraction_location.mkdir(exist_ok=True, parents=True)
-
-            tar_cmd: lib.utils.CmdList = [
-                'tar',
-                '-C', self.extraction_location,
-                f"--strip-components={self.strip_components}",
-                '-x',
-                '-f', local_tarball if local_tarball.exists() else '-',
-            ]  # fmt: off
-
-            comp_ext = local_tarball.suffix
-            if comp_ext == '.xz':
-                tar_cmd.append('-J')
-            elif comp_ext == '.zst':
-                tar_cmd.append('--zstd')
-            elif comp_ext != '.tar':
-                msg = f"Compression extension ('{comp_ext}') not supported!"
-                raise RuntimeError(msg)
+            with self.staging_folder() as staging:
+                tar_cmd = self.get_tar_cmd(local_tarball, local_tarball.suffix, Path(staging))
+                lib.utils.run(tar_cmd, show_cmd=True)
+                self.move_into_place(Path(staging))
 
-            tar_input = response.content if not local_tarball.exists() else None
-            lib.utils.run(tar_cmd, input=tar_input, show_cmd=True)
+        return downloaded
 
 
 class ToolchainManager:
     def __init__(self):
         self.download_folder: Path | None = None
         self.install_folder: Path | None = None
+        self.jobs: int = 1
+
+        self.cache: TarballCache | None = None
 
         self.host_arch: str = platform.machine()
 
@@ -179,6 +425,21 @@ class ToolchainManager:
                     lib.utils.print_green(f"INFO: Removing {install_prefix.name}...")
                     shutil.rmtree(install_prefix)
 
+            if self.cache:
+                self.cache.evict(version, latest_version)
+
+    def handle_tarballs(self, tarballs: list[Tarball]) -> None:
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            downloaded = sum(executor.map(Tarball.handle, tarballs))
+
+        if downloaded:
+            throughput = downloaded / max(time.time() - start, 1)
+            lib.utils.print_green(
+                f"INFO: Downloaded {format_size(downloaded)} in {lib.utils.get_duration(start)} ({format_size(throughput)}/s)"
+            )
+
     def print_latest_versions(self) -> None:
         if not self.latest_versions:
             print('Attempting to call print_latest_versions() without latest version?')
@@ -261,6 +522,10 @@ class GCCManager(ToolchainManager):
             'x86_64': 'x86_64',
         }[self.host_arch]
 
+        if cache:
+            self.cache = TarballCache(self.download_folder)
+
+        tarballs: list[Tarball] = []
         for major_version in self.versions:
             targets: list[str] = sorted({self.canonicalize_target(val) for val in self.targets})
 
@@ -306,9 +571,13 @@ class GCCManager(ToolchainManager):
                     tarball.extraction_location = extraction_location
 
                 if cache:
+                    tarball.cache = self.cache
                     tarball.remote_checksum_name = 'sha256sums.asc'
+                    tarball.version = full_version
 
-                tarball.handle()
+                tarballs.append(tarball)
+
+        self.handle_tarballs(tarballs)
 
     def print_folder(self, folder: str) -> None:
         if len(self.versions) != 1:
@@ -383,6 +652,7 @@ class LLVMManager(ToolchainManager):
             msg = 'Attempting to call install() with no install folder?'
             raise RuntimeError(msg)
 
+        tarballs: list[Tarball] = []
         for major_version in self.versions:
             full_version = self.latest_versions[major_version]
 
@@ -400,7 +670,9 @@ class LLVMManager(ToolchainManager):
             tarball.extracted_file = Path(extraction_location, 'bin/clang')
             tarball.extraction_location = extraction_location
 
-            tarball.handle()
+            tarballs.append(tarball)
+
+        self.handle_tarballs(tarballs)
 
     def print_folder(self, folder: str) -> None:
         if len(self.versions) != 1:
@@ -484,6 +756,13 @@ if __name__ == '__main__':
             metavar='TARGETS',
             nargs='+',
         )
+    install_parser.add_argument(
+        '-j',
+        '--jobs',
+        default=4,
+        help='Number of tarballs to download and extract in parallel (default: %(default)s)',
+        type=int,
+    )
     install_parser.add_argument(
         '-v',
         '--versions',
@@ -594,6 +873,7 @@ if __name__ == '__main__':
         manager.download_folder = args.download_folder.resolve()
         manager.host_arch = args.host_arch
         manager.install_folder = args.install_folder.resolve()
+        manager.jobs = args.jobs
 
         manager.install(args.cache, args.extract)
         if args.clean_up_old_versions:
@@ -15,15 +15,38 @@ import datetime
 import json
 import os
 import sys
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, zip_longest
 from pathlib import Path
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 import lib.sha256
 import lib.utils
 
+# 1MB at a time
+DOWNLOAD_CHUNK_SIZE = 1048576
+# Number of delta bundles to stack on top of a full bundle before creating a
+# new full bundle
+MAX_DELTA_BUNDLES = 30
+
+
+class HostPool:
+    def __init__(self, max_connections: int) -> None:
+        # Reuse connections to the same mirror across downloads
+        self.session: requests.Session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Mirrors tend to throttle clients that open too many connections
+        self.semaphore: threading.BoundedSemaphore = threading.BoundedSemaphore(max_connections)
+
 
 class DownloadItem:
     def __init__(self) -> None:
@@ -32,7 +55,7 @@ class DownloadItem:
         self.containing_folder: Path | None = None
         self.sha_url: str = ''
 
-    def download_if_necessary(self) -> None:
+    def download_if_necessary(self, pool: HostPool) -> Path:
         if not self.containing_folder:
             msg = 'Containing folder not configured?'
             raise RuntimeError(msg)
@@ -46,13 +69,22 @@ class DownloadItem:
             lib.utils.print_yellow(f"SKIP: {self.base_file} already downloaded!")
         else:
             target.parent.mkdir(exist_ok=True, parents=True)
-            lib.utils.print_green(f"INFO: {self.base_file} downloading...")
-            response = requests.get(self.file_url, timeout=3600)
-            response.raise_for_status()
-            target.write_bytes(response.content)
-
-        if self.sha_url:
-            lib.sha256.validate_from_url(target, self.sha_url)
+            # Download to a temporary file and rename it once it is complete
+            # so that an interrupted download is never mistaken for a complete
+            # one on the next run.
+            partial_target = target.with_name(f"{target.name}.part")
+            with (
+                pool.semaphore,
+                pool.session.get(self.file_url, stream=True, timeout=3600) as response,
+            ):
+                lib.utils.print_green(f"INFO: {self.base_file} downloading...")
+                response.raise_for_status()
+                with partial_target.open('wb') as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+            partial_target.replace(target)
+
+        return target
 
 
 def parse_parameters():
@@ -68,6 +100,26 @@ def parse_parameters():
         'ubuntu',
     ]  # fmt: off
 
+    parser.add_argument(
+        '-f',
+        '--full-bundles',
+        action='store_true',
+        help='Regenerate full git bundles instead of creating delta bundles',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default=8,
+        help='Number of items to download in parallel (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        '-m',
+        '--max-per-host',
+        default=2,
+        help='Number of parallel downloads allowed from a single mirror (default: %(default)s)',
+        type=int,
+    )
     parser.add_argument(
         '-t',
         '--targets',
@@ -95,7 +147,139 @@ def get_latest_ipsw_url(identifier: str, version: str) -> str:
     return version_firmwares[0]['url']
 
 
-def download_items(targets: list[str], network_folder: Path) -> None:
+def get_refs(repo_path: Path) -> dict[str, str]:
+    for_each_ref_out = lib.utils.get_git_output(
+        repo_path, ['for-each-ref', '--format=%(refname) %(objectname)']
+    )
+    return dict(line.split(' ', 1) for line in for_each_ref_out.splitlines())
+
+
+def is_in_delta_bundle(repo_path: Path, sha: str, old_refs: dict[str, str], old_tips: str) -> bool:
+    if sha in old_refs.values():
+        return False
+    # An annotated tag is a new object, even if it points to an existing commit
+    if lib.utils.get_git_output(repo_path, ['cat-file', '-t', sha]) == 'tag':
+        return True
+    return bool(
+        lib.utils.get_git_output(
+            repo_path, ['rev-list', '--max-count=1', '--stdin', sha], input=old_tips
+        )
+    )
+
+
+def update_bundle(repo_path: Path, bundles_folder: Path, full: bool) -> None:
+    state_file = Path(bundles_folder, f"{repo_path.name}.json")
+    state = json.loads(state_file.read_text(encoding='utf-8')) if state_file.exists() else {}
+    repo_bundle = Path(bundles_folder, f"{repo_path.name}.bundle")
+
+    if (refs := get_refs(repo_path)) == state.get('refs') and repo_bundle.exists() and not full:
+        lib.utils.print_yellow(f"SKIP: {repo_bundle.name} is up to date!")
+        return
+
+    full |= (
+        not repo_bundle.exists() or 'refs' not in state or len(state['deltas']) >= MAX_DELTA_BUNDLES
+    )
+    old_refs = state.get('refs', {})
+    # Every object reachable from the previous refs is already in the full
+    # bundle or an earlier delta bundle.
+    old_tips = ''.join(f"^{sha}\n" for sha in sorted(set(old_refs.values())))
+    changed_tips = {sha for ref, sha in refs.items() if old_refs.get(ref) != sha}
+    # A delta bundle leaves out refs that were rewound or created at an
+    # existing commit and git refuses to create it if that is true of every
+    # ref, so regenerate the full bundle in that case.
+    if not full and changed_tips:
+        full = not all(
+            is_in_delta_bundle(repo_path, sha, old_refs, old_tips) for sha in sorted(changed_tips)
+        )
+    # git also refuses to create a bundle without any new refs, which happens
+    # if refs were only deleted, so just record the new state in that case.
+    if not full and changed_tips:
+        delta_bundle = Path(
+            bundles_folder, f"{repo_path.name}-{len(state['deltas']) + 1:03d}.delta.bundle"
+        )
+        tmp_bundle = delta_bundle.with_name(f"{delta_bundle.name}.tmp")
+        lib.utils.call_git_loud(
+            repo_path,
+            ['bundle', 'create', tmp_bundle, '--all', '--stdin'],
+            input=old_tips,
+        )
+        tmp_bundle.replace(delta_bundle)
+        state['deltas'].append(delta_bundle.name)
+    elif full:
+        # Create the bundle under a temporary name so that the previous full
+        # bundle stays usable until the new one is complete.
+        tmp_bundle = repo_bundle.with_name(f"{repo_bundle.name}.tmp")
+        lib.utils.call_git_loud(repo_path, ['bundle', 'create', tmp_bundle, '--all'])
+        tmp_bundle.replace(repo_bundle)
+
+        for delta in state.get('deltas', []):
+            Path(bundles_folder, delta).unlink(missing_ok=True)
+        state['deltas'] = []
+        state['full'] = datetime.datetime.now(datetime.UTC).isoformat()
+
+    state['refs'] = refs
+    # Write the state to a temporary file then rename it so that an
+    # interrupted run cannot leave a corrupted state file behind.
+    tmp_state_file = state_file.with_name(f"{state_file.name}.tmp")
+    tmp_state_file.write_text(json.dumps(state, indent=4), encoding='utf-8')
+    tmp_state_file.replace(state_file)
+
+
+def sync_items(items: list[DownloadItem], jobs: int, max_per_host: int) -> None:
+    items_by_host: dict[str, list[DownloadItem]] = {}
+    for item in items:
+        items_by_host.setdefault(urlsplit(item.file_url).netloc, []).append(item)
+    pools = {host: HostPool(max_per_host) for host in items_by_host}
+
+    # Interleave the items from each mirror so that workers are not all stuck
+    # waiting on the connection limit of one mirror while others sit idle.
+    interleaved = [
+        item for item in chain.from_iterable(zip_longest(*items_by_host.values())) if item
+    ]
+
+    failed: list[str] = []
+    to_validate: dict[Path, DownloadItem] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(item.download_if_necessary, pools[urlsplit(item.file_url).netloc]): item
+            for item in interleaved
+        }
+        for future in as_completed(futures):
+            if err := future.exception():
+                lib.utils.print_red(f"ERROR: {futures[future].file_url}: {err}")
+                failed.append(futures[future].file_url)
+            elif futures[future].sha_url:
+                to_validate[future.result()] = futures[future]
+
+    # Hash all of the files once they are downloaded, so that hashing is
+    # spread over every core rather than limited by the number of downloads.
+    for target, computed_sha256 in lib.sha256.calculate_many(to_validate).items():
+        try:
+            expected_sha256 = lib.sha256.get_from_url(to_validate[target].sha_url, target.name)
+        except requests.RequestException as err:
+            lib.utils.print_red(f"ERROR: {to_validate[target].sha_url}: {err}")
+            failed.append(to_validate[target].file_url)
+            continue
+        if computed_sha256 == expected_sha256:
+            lib.utils.print_green(f"SUCCESS: {target.name} sha256 passed!")
+        else:
+            lib.utils.print_red(
+                f"ERROR: {target.name} computed checksum ('{computed_sha256}') did not match expected checksum ('{expected_sha256}')!"
+            )
+            failed.append(to_validate[target].file_url)
+
+    if failed:
+        msg = f"Failed to download or validate: {', '.join(failed)}"
+        raise RuntimeError(msg)
+
+
+def download_items(
+    targets: list[str],
+    network_folder: Path,
+    jobs: int = 8,
+    max_per_host: int = 2,
+    full_bundles: bool = False,
+) -> None:
     if not (firmware_folder := Path(network_folder, 'Firmware_and_Images')).exists():
         msg = f"{firmware_folder} does not exist, systemd automounting broken?"
         raise RuntimeError(msg)
@@ -146,10 +330,7 @@ def download_items(targets: list[str], network_folder: Path) -> None:
                     repo_path.parent.mkdir(exist_ok=True, parents=True)
                     lib.utils.call_git_loud(None, ['clone', '--mirror', repo_url, repo_path])
                 lib.utils.call_git_loud(repo_path, ['remote', 'update', '--prune'])
-                # Create bundles
-                repo_bundle = Path(bundles_folder, f"{repo_name}.bundle")
-                repo_bundle.unlink(missing_ok=True)
-                lib.utils.call_git_loud(repo_path, ['bundle', 'create', repo_bundle, '--all'])
+                update_bundle(repo_path, bundles_folder, full_bundles)
 
         elif target == 'debian':
             debian_arches = ['amd64', 'arm64', 'armhf']
@@ -256,8 +437,7 @@ def download_items(targets: list[str], network_folder: Path) -> None:
 
                     items.append(item)
 
-    for item in items:
-        item.download_if_necessary()
+    sync_items(items, jobs, max_per_host)
 
 
 if __name__ == '__main__':
@@ -267,4 +447,4 @@ if __name__ == '__main__':
         msg = f"{nas_folder} does not exist, setup systemd automount files?"
         raise RuntimeError(msg)
 
-    download_items(args.targets, nas_folder)
+    download_items(args.targets, nas_folder, args.jobs, args.max_per_host, args.full_bundles)
@@ -12,11 +12,19 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2023 Nathan Chancellor
 
+import datetime
+import json
+import multiprocessing
+import os
 import shutil
 import signal
+import statistics
+import subprocess
 import sys
+import threading
 import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import korg_tc
@@ -25,13 +33,103 @@ import korg_tc
 import tuxmake.build
 
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import lib.kernel
 import lib.utils
 
+# Rough order of how long each configuration takes to build, so that the
+# longest builds can be started first.
+KCONFIG_PRIORITY: dict[str, int] = {
+    'allmodconfig': 0,
+    'defconfig': 1,
+    'allnoconfig': 2,
+}
+# Serializes writes to results.log and the console between parallel builds,
+# which is replaced with a lock shared with the build processes by
+# init_worker() when builds run in parallel
+OUTPUT_LOCK = threading.Lock()
+# A build that takes this much longer than it has in the past is flagged
+REGRESSION_THRESHOLD = 1.2
+# Amount of a failed build's log to show when builds run in parallel
+BUILD_LOG_TAIL_SIZE = 4096
+
+
+class BuildHistory:
+    # Number of previous runs to keep for each build
+    MAX_RECORDS = 20
+
+    def __init__(self, history_file: Path) -> None:
+        self.history_file: Path = history_file
+        self.builds: dict[str, list[dict]] = (
+            json.loads(history_file.read_text(encoding='utf-8')) if history_file.exists() else {}
+        )
+
+    @staticmethod
+    def get_key(toolchain: str, target_arch: str, kconfig: str) -> str:
+        return f"{toolchain} {target_arch} {kconfig}"
+
+    def estimate(self, key: str) -> float | None:
+        # Failed builds may stop early, so they say nothing about how long a
+        # build takes. Builds of other commits are close enough for time
+        # estimates.
+        if durations := [run['duration'] for run in self.builds.get(key, []) if run['passed']]:
+            return statistics.median(durations)
+        return None
+
+    def get_baseline(
+        self, key: str, commit: str, toolchain_version: str | None
+    ) -> tuple[float, str | None] | None:
+        # Only builds of the same commit can show a regression. Compare a new
+        # toolchain against the toolchain that was used before it, otherwise
+        # against all previous builds of the same commit. Return the toolchain
+        # version that was compared against, if any.
+        if not (
+            runs := [
+                run for run in self.builds.get(key, []) if run['passed'] and run['commit'] == commit
+            ]
+        ):
+            return None
+        if previous := [
+            run for run in runs if run.get('toolchain_version') not in {None, toolchain_version}
+        ]:
+            previous_version = previous[-1]['toolchain_version']
+            durations = [
+                run['duration'] for run in previous if run['toolchain_version'] == previous_version
+            ]
+            return statistics.median(durations), previous_version
+        return statistics.median(run['duration'] for run in runs), None
+
+    def record(
+        self, key: str, commit: str, toolchain_version: str | None, duration: float, passed: bool
+    ) -> None:
+        runs = self.builds.setdefault(key, [])
+        runs.append(
+            {
+                'commit': commit,
+                'date': datetime.datetime.now(datetime.UTC).isoformat(),
+                'duration': duration,
+                'passed': passed,
+                'toolchain_version': toolchain_version,
+            }
+        )
+        del runs[: -self.MAX_RECORDS]
+
+        self.history_file.parent.mkdir(exist_ok=True, parents=True)
+        tmp_file = self.history_file.with_name(f"{self.history_file.name}.tmp")
+        tmp_file.write_text(json.dumps(self.builds, indent=4, sort_keys=True), encoding='utf-8')
+        tmp_file.replace(self.history_file)
+
 
 def interrupt_handler(_signum, _frame):
     sys.exit(130)
 
 
+def init_worker(output_lock) -> None:
+    global OUTPUT_LOCK  # ruff:ignore[global-statement]
+    OUTPUT_LOCK = output_lock
+
+    signal.signal(signal.SIGINT, interrupt_handler)
+
+
 def parse_arguments():
     parser = ArgumentParser(description='Do a series of builds with GCC from kernel.org')
 
@@ -92,6 +190,37 @@ def parse_arguments():
         help='Output folder for build artifacts (default: build folder in kernel source)',
     )
 
+    parser.add_argument(
+        '--history-file',
+        default=Path(
+            os.environ.get('XDG_DATA_FOLDER', Path.home().joinpath('.local/share')),
+            'tuxmake_bld_all/history.json',
+        ),
+        help='File to store build durations in for time estimates (default: %(default)s)',
+        type=Path,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default=os.cpu_count(),
+        help='Number of CPUs to share between all builds (default: %(default)s)',
+        type=int,
+    )
+    parser.add_argument(
+        '-p',
+        '--parallel',
+        default=max(1, (os.cpu_count() or 1) // 32),
+        help='Number of builds to run at the same time (default: %(default)s)',
+        type=int,
+    )
+
+    parser.add_argument(
+        '-r',
+        '--resume',
+        action='store_true',
+        help='Keep the output folder from a previous run and only do builds that did not pass',
+    )
+
     parser.add_argument(
         '--use-ccache',
         action='store_true',
@@ -134,6 +263,14 @@ def get_env_make_variables(
     return environment, make_variables
 
 
+def get_toolchain_version(target_arch: str, toolchain: str) -> str | None:
+    _, make_variables = get_env_make_variables(target_arch, toolchain)
+    try:
+        return lib.kernel.get_tool_version(f"{make_variables['CROSS_COMPILE']}gcc")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
 def get_targets(kconfig: str) -> list[str]:
     targets = ['default']
     if kconfig == 'defconfig':
@@ -149,15 +286,33 @@ def build_one(
     wrapper: str | None,
     kconfig: str,
     results_file: Path,
-) -> None:
+    jobs: int | None = None,
+    load: int | None = None,
+) -> tuple[float, bool]:
     bld_str = f"ARCH={target_arch} {kconfig} {toolchain}"
 
-    lib.utils.print_header(bld_str)
-
-    config_output_dir = f"{output_dir}/{target_arch}/{kconfig}"
+    config_output_dir = f"{output_dir}/{toolchain}/{target_arch}/{kconfig}"
     Path(config_output_dir).mkdir(exist_ok=True, parents=True)
+    # Use a persistent build folder so that a failed or interrupted build can
+    # be resumed incrementally rather than from scratch
+    build_dir = Path(config_output_dir, 'build')
+
+    # When builds run in parallel, their output would be interleaved, so just
+    # point to tuxmake's log file instead.
+    if quiet := bool(load):
+        with OUTPUT_LOCK:
+            lib.utils.print_green(f"INFO: Starting {bld_str} (log: {config_output_dir}/build.log)")
+    else:
+        lib.utils.print_header(bld_str)
 
     environment, make_variables = get_env_make_variables(target_arch, toolchain)
+    # Nothing coordinates jobs between parallel builds. Each build may use
+    # more than its share of jobs so that the CPUs left idle by another
+    # build's configuration, link, or modpost phases can be used, while make
+    # will not start new jobs once the load average of the system reaches the
+    # number of CPUs.
+    if load:
+        environment['MAKEFLAGS'] = f"-l{load}"
 
     result = tuxmake.build.build(
         tree=tree,
@@ -168,6 +323,9 @@ def build_one(
         environment=environment,
         make_variables=make_variables,
         targets=get_targets(kconfig),
+        build_dir=build_dir,
+        jobs=jobs,
+        quiet=quiet,
     )
 
     duration = 0
@@ -176,15 +334,42 @@ def build_one(
         duration += info.duration
         passed &= info.passed
 
+    # A build that passed will not be done again so its objects are no longer
+    # needed
+    if passed:
+        shutil.rmtree(build_dir)
+
     res_str = 'PASS' if passed else 'FAIL'
     duration_str = lib.utils.get_duration(0, duration)
-    with results_file.open(encoding='utf-8', mode='a') as file:
-        file.write(f"{bld_str}: {res_str} in {duration_str}\n")
+    # Builds finish in any order, so make sure that lines are not interleaved
+    with OUTPUT_LOCK:
+        with results_file.open(encoding='utf-8', mode='a') as file:
+            file.write(f"{bld_str}: {res_str} in {duration_str}\n")
+        if quiet:
+            (lib.utils.print_green if passed else lib.utils.print_red)(
+                f"{'INFO' if passed else 'ERROR'}: {bld_str}: {res_str} in {duration_str}"
+            )
+            # The output of the build was not shown, so show the end of the
+            # log, which should contain the error, without reading all of it
+            # into memory.
+            if not passed and (build_log := Path(config_output_dir, 'build.log')).exists():
+                tail = lib.utils.OutputTail(BUILD_LOG_TAIL_SIZE)
+                with build_log.open(encoding='utf-8', errors='replace') as file:
+                    for line in file:
+                        tail.append(line)
+                print(tail.get(), end='', flush=True)
+
+    return duration, passed
 
 
 def process_results(results_file: Path, start_time: float) -> None:
     print()
 
+    # Nothing may have been built, such as when resuming a run that is done
+    if not results_file.exists():
+        print(f"No results found in {results_file}")
+        return
+
     failed = []
     passed = []
     for line in results_file.read_text(encoding='utf-8').splitlines(keepends=True):
@@ -209,21 +394,156 @@ def build_all(
     toolchains: list[str],
     use_ccache: bool,
     results_file: Path,
+    jobs: int | None = None,
+    parallel: int = 1,
+    history_file: Path | None = None,
+    resume: bool = False,
 ) -> None:
-    for toolchain in toolchains:
-        for target_arch in architectures:
-            if int(toolchain.split('-')[1]) < 7 and target_arch == 'riscv':
-                continue
-            for kconfig in get_kconfigs_for_target(targets):
-                build_one(
-                    tree=linux_folder,
-                    output_dir=out_folder,
-                    target_arch=target_arch,
-                    toolchain=toolchain,
-                    wrapper='ccache' if use_ccache and shutil.which('ccache') else None,
-                    kconfig=kconfig,
-                    results_file=results_file,
-                )
+    builds = [
+        (toolchain, target_arch, kconfig)
+        for toolchain in toolchains
+        for target_arch in architectures
+        if not (int(toolchain.split('-')[1]) < 7 and target_arch == 'riscv')
+        for kconfig in get_kconfigs_for_target(targets)
+    ]
+
+    if resume and results_file.exists():
+        # Only keep the results of builds that passed, as the rest will be
+        # done again and get new results
+        passed_lines = [
+            line
+            for line in results_file.read_text(encoding='utf-8').splitlines(keepends=True)
+            if line.split(': ', 1)[1].startswith('PASS')
+        ]
+        results_file.write_text(''.join(passed_lines), encoding='utf-8')
+
+        already_passed = {line.split(': ', 1)[0] for line in passed_lines}
+        for build in builds.copy():
+            if (bld_str := f"ARCH={build[1]} {build[2]} {build[0]}") in already_passed:
+                lib.utils.print_yellow(f"SKIP: {bld_str} already passed!")
+                builds.remove(build)
+
+    if not builds:
+        lib.utils.print_yellow('SKIP: No builds left to do!')
+        return
+
+    history = BuildHistory(history_file) if history_file else None
+    estimates = {
+        build: history.estimate(BuildHistory.get_key(*build)) if history else None
+        for build in builds
+    }
+
+    # Start the longest builds first so that they do not end up running alone
+    # at the end while the rest of the CPUs sit idle. Go by configuration
+    # first then by how long a build took in the past (sorted() is stable, so
+    # builds keep their original order otherwise).
+    if parallel > 1:
+        builds = sorted(
+            builds,
+            key=lambda build: (KCONFIG_PRIORITY.get(build[2], 0), -(estimates[build] or 0)),
+        )
+
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    build_kwargs = {
+        'tree': linux_folder,
+        'output_dir': out_folder,
+        'wrapper': 'ccache' if use_ccache and shutil.which('ccache') else None,
+        'results_file': results_file,
+    }
+    if parallel > 1:
+        build_kwargs['jobs'] = min(jobs, max(1, jobs // parallel * 2))
+        build_kwargs['load'] = jobs
+    else:
+        build_kwargs['jobs'] = jobs
+
+    commit = lib.utils.get_git_output(linux_folder, ['rev-parse', 'HEAD'], check=False)
+    # The toolchain for each major version may be updated between runs, which
+    # is what the history is most likely to catch a regression from.
+    toolchain_versions = (
+        {
+            (toolchain, target_arch): get_toolchain_version(target_arch, toolchain)
+            for toolchain, target_arch, _ in builds
+        }
+        if history
+        else {}
+    )
+
+    def handle_result(build: tuple[str, str, str], duration: float, passed: bool) -> None:
+        if history:
+            key = BuildHistory.get_key(*build)
+            toolchain_version = toolchain_versions[build[:2]]
+            if passed and (baseline := history.get_baseline(key, commit, toolchain_version)):
+                estimate, baseline_version = baseline
+                if duration > estimate * REGRESSION_THRESHOLD:
+                    lib.utils.print_yellow(
+                        f"WARNING: ARCH={build[1]} {build[2]} {build[0]} took {lib.utils.get_duration(0, duration)}, {(duration / estimate - 1) * 100:.0f}% longer than {f'with {baseline_version}' if baseline_version else 'usual'} ({lib.utils.get_duration(0, estimate)})!"
+                    )
+            history.record(key, commit, toolchain_version, duration, passed)
+
+        del estimates[build]
+        print_eta(estimates, parallel)
+
+    print_eta(estimates, parallel)
+
+    # tuxmake installs signal handlers, which can only be done from the main
+    # thread, so builds have to happen in the main thread of a process.
+    if parallel == 1:
+        for build in builds:
+            toolchain, target_arch, kconfig = build
+            handle_result(
+                build,
+                *build_one(
+                    target_arch=target_arch, toolchain=toolchain, kconfig=kconfig, **build_kwargs
+                ),
+            )
+        return
+
+    # Fork the workers so that they inherit the imported modules and the
+    # state of this process, which is not the default start method on all
+    # Python versions.
+    mp_context = multiprocessing.get_context('fork')
+    init_worker(output_lock := mp_context.Lock())
+    with ProcessPoolExecutor(
+        max_workers=parallel,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(output_lock,),
+    ) as executor:
+        futures = {
+            executor.submit(
+                build_one,
+                target_arch=target_arch,
+                toolchain=toolchain,
+                kconfig=kconfig,
+                **build_kwargs,
+            ): (toolchain, target_arch, kconfig)
+            for toolchain, target_arch, kconfig in builds
+        }
+        try:
+            for future in as_completed(futures):
+                handle_result(futures[future], *future.result())
+        except BaseException:
+            # Do not start any more builds if one failed to run or the user
+            # interrupted the script, so that it can be resumed later
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def print_eta(estimates: dict[tuple[str, str, str], float | None], parallel: int) -> None:
+    if not estimates:
+        return
+
+    known = [estimate for estimate in estimates.values() if estimate is not None]
+    msg = f"INFO: {len(estimates)} build{'s' if len(estimates) > 1 else ''} remaining"
+    if known:
+        # This assumes parallel builds scale perfectly, which they do not, but
+        # it is a good enough rough estimate.
+        msg += f", estimated time remaining: {lib.utils.get_duration(0, sum(known) / parallel)}"
+        if unknown := len(estimates) - len(known):
+            msg += f" (plus {unknown} without history)"
+    with OUTPUT_LOCK:
+        lib.utils.print_green(msg)
 
 
 if __name__ == '__main__':
@@ -234,7 +554,7 @@ if __name__ == '__main__':
     if not (output := args.output_dir):
         output = Path(args.directory, 'build')
 
-    if (output := Path(output).resolve()).exists():
+    if (output := Path(output).resolve()).exists() and not args.resume:
         shutil.rmtree(output)
 
     results = Path(output, 'results.log')
@@ -248,6 +568,10 @@ if __name__ == '__main__':
         toolchains=args.toolchains,
         use_ccache=args.use_ccache,
         results_file=results,
+        jobs=args.jobs,
+        parallel=args.parallel,
+        history_file=args.history_file,
+        resume=args.resume,
     )
 
     process_results(results, start)